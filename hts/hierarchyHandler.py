@@ -1,45 +1,338 @@
 # Numpy and pandas
 import numpy as np
+import pandas as pd
+import scipy.sparse as sps
 
+from htsProfiler import gNoStage
 
-class cHierarchyHandler:
-    def __init__(self, iHierarchyDf=None, iHierarchyOrder=None):
+
+def get_label_codes(iLabelIndex, iLabels):
+    """
+
+    :param iLabelIndex: pd.Index of labels
+    :param iLabels: array, Series or Categorical of labels
+    :return: int32 array of the position of each label in iLabelIndex (-1 if missing), only the categories of
+    categorical labels are looked up
+    """
+    lLabels = iLabels.values if isinstance(iLabels, pd.Series) else iLabels
+    if isinstance(lLabels, pd.Categorical):
+        # Last item is the code of missing values (categorical code -1)
+        lCategoryCodes = np.append(iLabelIndex.get_indexer(lLabels.categories), -1).astype(np.int32)
+        return lCategoryCodes[lLabels.codes]
+    return iLabelIndex.get_indexer(lLabels).astype(np.int32)
+
+
+class cNodeRegistry(object):
+    def __init__(self, iLevelLabels):
+        """
+
+        Interns node labels : a node of a level is its int32 code (position of its label in the sorted labels of the
+        level). Structures, indexes and intermediate arrays use codes, labels are only decoded in outputs.
+        :param iLevelLabels: dict {level : sorted array of labels}
+        """
+        self.mLabelIndexes = dict((level, pd.Index(lLabels)) for level, lLabels in iLevelLabels.items())
+        self.mDtypes = dict((level, pd.api.types.CategoricalDtype(lIndex))
+                            for level, lIndex in self.mLabelIndexes.items())
+
+    def encode(self, iLevel, iLabels):
+        """
+
+        :param iLevel: level
+        :param iLabels: array, Series or Categorical of labels of iLevel
+        :return: int32 array of codes (-1 for labels which are not in the hierarchy)
+        """
+        return get_label_codes(self.mLabelIndexes[iLevel], iLabels)
+
+    def decode(self, iLevel, iCodes):
+        """
+
+        :param iLevel: level
+        :param iCodes: array of codes of iLevel
+        :return: Categorical of labels (categories are all labels of iLevel)
+        """
+        return pd.Categorical.from_codes(iCodes, dtype=self.mDtypes[iLevel])
+
+    def encode_level_columns(self, iDf, iLevelCols):
+        """
+
+        :param iDf: DF with level columns
+        :param iLevelCols: dict {level : column}
+        :return: copy of iDf with level columns as Categorical of the registry (labels stored once)
+        """
+        oDf = iDf.copy()
+        for level, col in iLevelCols.items():
+            lCodes = self.encode(level, oDf.loc[:, col])
+            if (lCodes < 0).any():
+                raise ValueError('Column ' + str(col) + ' contains nodes which are not in the hierarchy')
+            oDf.loc[:, col] = self.decode(level, lCodes)
+        return oDf
+
+
+class cHierarchyStructure(object):
+    def __init__(self, iHierarchyDf, iLevels, iParentLevels=None, iChildLevels=None, iLevelLinks=None):
+        """
+
+        Array based structure of the hierarchy : nodes are numbered by level (0 first) then by label, which is also
+        the order of the rows of the sparse summing matrix
+        :param iHierarchyDf: a Df with the hierarchy, with no duplicates and levels as column names
+        :param iLevels: list of levels (0 is the base level)
+        :param iParentLevels: dict {level : level of parents}, parents form a tree used by TD (level + 1 if None)
+        :param iChildLevels: dict {level : level of children}, children are summed by BU (level - 1 if None)
+        :param iLevelLinks: list of (level, coarser level) whose nodes must have a single parent (parents and
+        children levels if None)
+        """
+        self.mLevels = sorted(iLevels)
+        if iParentLevels is None:
+            iParentLevels = dict((level, level + 1) for level in self.mLevels[:-1])
+        if iChildLevels is None:
+            iChildLevels = dict((level, level - 1) for level in self.mLevels[1:])
+        if iLevelLinks is None:
+            iLevelLinks = sorted(set(list(iParentLevels.items()) + [(v, k) for k, v in iChildLevels.items()]))
+        self.mParentLevels = iParentLevels
+        self.mChildLevels = iChildLevels
+        self.mLevelLinks = iLevelLinks
+
+        # Node code of each row of the hierarchy, for each level
+        self.mRowCodes = {}
+        self.mLevelLabels = {}
+        self.mLevelOffsets = {}
+        lOffset = 0
+        for level in self.mLevels:
+            lCodes, lUniques = pd.factorize(iHierarchyDf[level].values, sort=True)
+            self.mRowCodes[level] = lCodes.astype(np.int32)
+            self.mLevelLabels[level] = np.asarray(lUniques, dtype=object)
+            self.mLevelOffsets[level] = lOffset
+            lOffset += len(lUniques)
+        self.mNbNodes = lOffset
+
+        # Unique (child, parent) links between each level and its parent level
+        lEdgeKeys = [np.unique(self.create_edge_keys(level, self.mParentLevels[level]))
+                     for level in self.mLevels if level in self.mParentLevels]
+        lEdgeKeys = np.concatenate(lEdgeKeys) if len(lEdgeKeys) > 0 else np.zeros(0, dtype=np.int64)
+        self.mEdgeChildren = lEdgeKeys // self.mNbNodes
+        self.mEdgeParents = lEdgeKeys % self.mNbNodes
+
+        # Parent of each node (-1 for the highest level)
+        self.mParentIndex = np.repeat(-1, self.mNbNodes)
+        self.mParentIndex[self.mEdgeChildren] = self.mEdgeParents
+
+        # Children of node i are mChildIndex[mChildPtr[i]:mChildPtr[i + 1]]
+        self.mChildIndex = self.mEdgeChildren[np.argsort(self.mEdgeParents, kind='mergesort')]
+        self.mChildPtr = np.concatenate(([0], np.cumsum(np.bincount(self.mEdgeParents, minlength=self.mNbNodes))))
+
+        self.mNodeRegistry = cNodeRegistry(self.mLevelLabels)
+        self.mNodeIndex = pd.MultiIndex.from_arrays(
+            [np.repeat(self.mLevels, [len(self.mLevelLabels[level]) for level in self.mLevels]),
+             np.concatenate([self.mLevelLabels[level] for level in self.mLevels])], names=['Level', 'Node'])
+
+        self.mDict = None
+
+    def create_edge_keys(self, iLevel, iCoarserLevel):
+        """
+
+        :param iLevel: level of children
+        :param iCoarserLevel: level of parents
+        :return: array of child node * nb nodes + parent node, for each row of the hierarchy
+        """
+        return (self.mLevelOffsets[iLevel] + self.mRowCodes[iLevel].astype(np.int64)) * self.mNbNodes + \
+            self.mLevelOffsets[iCoarserLevel] + self.mRowCodes[iCoarserLevel]
+
+    def create_aggregation_matrix(self, iLevel):
+        """
+
+        :param iLevel: level (with children level)
+        :return: sparse matrix (nodes of iLevel x nodes of its children level) summing children into iLevel nodes
+        """
+        lChildLevel = self.mChildLevels[iLevel]
+        lKeys = np.unique(self.mRowCodes[lChildLevel].astype(np.int64) * len(self.mLevelLabels[iLevel]) +
+                          self.mRowCodes[iLevel])
+        return sps.csr_matrix((np.ones(len(lKeys)), (lKeys % len(self.mLevelLabels[iLevel]),
+                                                     lKeys // len(self.mLevelLabels[iLevel]))),
+                              shape=(len(self.mLevelLabels[iLevel]), len(self.mLevelLabels[lChildLevel])))
+
+    def validate(self):
+        """
+
+        Checks that each node has a single parent for each link between levels
+        Links always go to a higher level (level + 1, or a coarser combination of axes for grouped hierarchies) : the
+        level numbering rules out cycles. Nodes are (level, label) : a label used at several levels is a different
+        node at each level.
+        Raises ValueError if structure is not valid
+        """
+        lLabels = self.mNodeIndex.get_level_values(1).values
+        for level, lCoarserLevel in self.mLevelLinks:
+            lKeys = np.unique(self.create_edge_keys(level, lCoarserLevel))
+            lChildren = lKeys // self.mNbNodes
+            lMultipleParents = np.unique(lChildren[1:][lChildren[1:] == lChildren[:-1]])
+            if len(lMultipleParents) > 0:
+                raise ValueError('Nodes with several parents between levels ' + str(level) + ' and ' +
+                                 str(lCoarserLevel) + ' : ' + ', '.join(map(str, lLabels[lMultipleParents][:10])))
+
+    def get_level_slice(self, iLevel):
+        """
+
+        :param iLevel: level
+        :return: slice of the nodes of iLevel
+        """
+        return slice(self.mLevelOffsets[iLevel], self.mLevelOffsets[iLevel] + len(self.mLevelLabels[iLevel]))
+
+    def get_children(self, iNode):
+        """
+
+        :param iNode: node number
+        :return: array of node numbers of its children
+        """
+        return self.mChildIndex[self.mChildPtr[iNode]:self.mChildPtr[iNode + 1]]
+
+    def to_dict(self):
+        """
+
+        Dict view {level : {node label : set of children labels}}, computed at first call
+        :return: the dict view of the structure
+        """
+        if self.mDict is None:
+            lLabels = self.mNodeIndex.get_level_values(1).values
+            self.mDict = {}
+            for level in self.mLevels:
+                lOffset = self.mLevelOffsets[level]
+                self.mDict[level] = dict((label, set(lLabels[self.get_children(lOffset + i)]))
+                                         for i, label in enumerate(self.mLevelLabels[level]))
+        return self.mDict
+
+
+class cHierarchyHandler(object):
+    def __init__(self, iHierarchyDf=None, iHierarchyOrder=None, iProfiler=None):
         """
 
         :param iHierarchyDf: a Df with the hierarchy
         :param iHierarchyOrder: a dict with names and level values : 0 is the base level (most granular)
+        For a grouped hierarchy, a list of such dicts (1 per axis, without total level) : levels are then all the
+        combinations of 1 level (or total) of each axis, see create_grouped_hierarchy_order
+        :param iProfiler: cHtsProfiler recording each stage of methods (no instrumentation if None)
         """
+        self.mProfiler = iProfiler
+        self.mAxesOrders = None
+        self.mParentLevels = None
+        self.mChildLevels = None
+        self.mLevelLinks = None
+        if isinstance(iHierarchyOrder, list):
+            self.mAxesOrders = iHierarchyOrder
+            iHierarchyOrder = self.create_grouped_hierarchy_order()
+            iHierarchyDf = self.add_grouping_columns(iHierarchyDf).loc[:, list(iHierarchyOrder.keys())]
         self.mHierarchy = iHierarchyDf
         self.mHierarchyOrder = iHierarchyOrder
         self.mRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+        self.mCompactStructure = None
 
-    def create_structure(self):
+    def create_grouped_hierarchy_order(self):
         """
 
-        :return: the structure from hierarchyDf and hierarchyOrder
+        Each level of a grouped hierarchy is a combination of 1 level of each axis (level index len(axis) being the
+        total of the axis). Levels are numbered by sum of axis level indexes : 0 is the combination of base levels.
+        Parent level (used by TD) coarsens the first axis which is not total, children level (used by BU) refines
+        the first axis which is not at base level.
+        :return: hierarchy order {level name : level}
         """
-        self.mHierarchy = self.mHierarchy.drop_duplicates()
-        self.mHierarchy = self.mHierarchy.set_index(np.array(range(self.mHierarchy.shape[0])))
-        self.mHierarchy = self.mHierarchy.rename(columns=self.mHierarchyOrder)
+        lAxes = [sorted(lOrder.keys(), key=lambda col: lOrder[col]) for lOrder in self.mAxesOrders]
+        lAxesCols = [col for lAxis in lAxes for col in lAxis]
+        if len(set(lAxesCols)) != len(lAxesCols):
+            raise ValueError('A column is used in several axes of grouped hierarchy')
 
-        # Create the structure of hierarchy
-        oStructure = {}
-        # List of levels
-        lLevels = self.mHierarchy.columns.values
+        lCombinations = [()]
+        for lAxis in lAxes:
+            lCombinations = [c + (i,) for c in lCombinations for i in range(len(lAxis) + 1)]
+        lCombinations = sorted(lCombinations, key=lambda c: (sum(c), c))
+        lLevels = dict((c, level) for level, c in enumerate(lCombinations))
 
-        # For each level, create an empty dict
-        for level in sorted(lLevels):
-            oStructure[level] = {}
-        # Fill it !
-        for row in range(self.mHierarchy.shape[0]):
-            for level in lLevels:
-                col = self.mHierarchy[level][row]
-                if col not in oStructure[level].keys():
-                    oStructure[level][col] = set()
-                if level > 0:
-                    col1 = self.mHierarchy[level - 1][row]
-                    oStructure[level][col].add(col1)
+        self.mGroupingCols = {}
+        self.mParentLevels = {}
+        self.mChildLevels = {}
+        self.mLevelLinks = []
+        oHierarchyOrder = {}
+        for c, level in lLevels.items():
+            lCols = [lAxes[a][i] for a, i in enumerate(c) if i < len(lAxes[a])]
+            self.mGroupingCols[level] = lCols
+            oHierarchyOrder['|'.join(lCols) if len(lCols) > 0 else 'All'] = level
+            lCoarser = [c[:a] + (i + 1,) + c[a + 1:] for a, i in enumerate(c) if i < len(lAxes[a])]
+            lFiner = [c[:a] + (i - 1,) + c[a + 1:] for a, i in enumerate(c) if i > 0]
+            if len(lCoarser) > 0:
+                self.mParentLevels[level] = lLevels[lCoarser[0]]
+            if len(lFiner) > 0:
+                self.mChildLevels[level] = lLevels[lFiner[0]]
+            self.mLevelLinks += [(level, lLevels[lCoarse]) for lCoarse in lCoarser]
+
+        return oHierarchyOrder
+
+    def add_grouping_columns(self, iDf):
+        """
+
+        Adds to iDf a column for each level of grouped hierarchy combining several axes (labels joined by '|') and
+        the 'All' column for the total
+        :param iDf: DF with the columns of all axes
+        :return: copy of iDf with the grouping columns
+        """
+        oDf = iDf.copy()
+        for level, lCols in self.mGroupingCols.items():
+            if len(lCols) == 0:
+                oDf.loc[:, 'All'] = 'All'
+            elif len(lCols) > 1:
+                lLabels = oDf.loc[:, lCols[0]].astype(str)
+                for col in lCols[1:]:
+                    lLabels = lLabels + '|' + oDf.loc[:, col].astype(str)
+                oDf.loc[:, '|'.join(lCols)] = lLabels.values
+        return oDf
+
+    def profile(self, iMethod, iStage):
+        """
+
+        :return: context measuring a stage with the profiler (shared context doing nothing without profiler)
+        """
+        if self.mProfiler is None:
+            return gNoStage
+        return self.mProfiler.stage(iMethod, iStage)
+
+    @property
+    def mStructure(self):
+        """
 
+        Dict view of the structure (see create_structure)
+        """
+        return self.create_structure()
+
+    def get_compact_structure(self):
+        """
+
+        :return: the array based structure (cHierarchyStructure), computed at first call only
+        """
+        if self.mCompactStructure is None:
+            with self.profile('get_compact_structure', 'build') as lStage:
+                self.mHierarchy = self.mHierarchy.drop_duplicates()
+                self.mHierarchy = self.mHierarchy.set_index(np.array(range(self.mHierarchy.shape[0])))
+                self.mHierarchy = self.mHierarchy.rename(columns=self.mHierarchyOrder)
+                self.mCompactStructure = cHierarchyStructure(self.mHierarchy, self.mRevHierarchyOrder.keys(),
+                                                             self.mParentLevels, self.mChildLevels, self.mLevelLinks)
+                lStage.add_counts(rows=self.mHierarchy.shape[0], nodes=self.mCompactStructure.mNbNodes,
+                                  edges=len(self.mCompactStructure.mEdgeChildren))
+            with self.profile('get_compact_structure', 'validate'):
+                self.mCompactStructure.validate()
+        return self.mCompactStructure
+
+    def get_node_registry(self):
+        """
+
+        :return: registry of node codes of each level (cNodeRegistry)
+        """
+        return self.get_compact_structure().mNodeRegistry
+
+    def create_structure(self):
+        """
+
+        :return: the structure from hierarchyDf and hierarchyOrder : {level : {node : set of children}}
+        """
+        lStructure = self.get_compact_structure()
+        with self.profile('create_structure', 'to_dict') as lStage:
+            oStructure = lStructure.to_dict()
+            lStage.add_counts(nodes=lStructure.mNbNodes)
         return oStructure
 
     def create_summing_matrix(self):
@@ -47,30 +340,29 @@ class cHierarchyHandler:
 
         iHierachy is as DF with the hierarchy of data
         level 0 is the base level (most granular level)
-        :return: the summing matrix
-        """
-        lStructure = self.create_structure()
-
-        lNbNodes = sum([len(lStructure[level]) for level in lStructure.keys()])
-        lBaseLevelCount = len(lStructure[0])
-
-        lIndices = {}
-        # Summing matrix
-        oSummingMatrix = np.zeros((lNbNodes, lBaseLevelCount))
-        for level in lStructure.keys():
-            if level > 0:
-                for col in lStructure[level].keys():
-                    i = len(lIndices)
-                    lIndices[col] = i
-                    for col1 in lStructure[level][col]:
-                        ii = lIndices[col1]
-                        for j in range(lBaseLevelCount):
-                            oSummingMatrix[i][j] = oSummingMatrix[ii][j] + oSummingMatrix[i][j]
-            else:
-                # Base level filling
-                for col in lStructure[level].keys():
-                    lNew_index = len(lIndices)
-                    lIndices[col] = lNew_index
-                    oSummingMatrix[lNew_index][lNew_index] = 1
-
-        return oSummingMatrix
+        :return: the summing matrix (dense), rows and columns in the order of create_sparse_summing_matrix
+        """
+        return self.create_sparse_summing_matrix()[0].toarray()
+
+    def create_sparse_summing_matrix(self):
+        """
+
+        Sparse summing matrix built without any loop from the integer codes of each level
+        Rows are ordered by level (0 first) then by label, columns are the base level nodes in the same order
+        :return: the summing matrix (scipy CSR matrix), node index (MultiIndex (Level, Node) of each row)
+        """
+        lStructure = self.get_compact_structure()
+
+        with self.profile('create_sparse_summing_matrix', 'build') as lStage:
+            # Each row of the hierarchy links its base node to its node at each level
+            lRows = np.concatenate([lStructure.mLevelOffsets[level] + lStructure.mRowCodes[level]
+                                    for level in lStructure.mLevels])
+            lCols = np.tile(lStructure.mRowCodes[0], len(lStructure.mLevels))
+
+            oSummingMatrix = sps.coo_matrix((np.ones(len(lRows)), (lRows, lCols)),
+                                            shape=(lStructure.mNbNodes, len(lStructure.mLevelLabels[0]))).tocsr()
+            # Duplicated (row, col) pairs are summed by the conversion : summing matrix only holds ones
+            oSummingMatrix.data[:] = 1.
+            lStage.add_counts(nodes=oSummingMatrix.shape[0], nnz=oSummingMatrix.nnz)
+
+        return oSummingMatrix, lStructure.mNodeIndex
@@ -0,0 +1,199 @@
+# Base forecasts of every node of the hierarchy, fitted in parallel
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+# Shared arrays of pool workers (set by init_pool_worker)
+gWorkerArrays = {}
+
+
+def create_shared_array(iArray):
+    """
+
+    :param iArray: float array
+    :return: shared memory copy of iArray (RawArray) and numpy view on it
+    """
+    lRawArray = multiprocessing.RawArray('d', int(np.prod(iArray.shape)))
+    oArray = np.frombuffer(lRawArray, dtype=np.float64).reshape(iArray.shape)
+    oArray[:] = iArray
+    return lRawArray, oArray
+
+
+def predict_estimators(iModel, iFeatures):
+    """
+
+    Sample function of cHtsForecaster for ensemble models (e.g. random forests)
+    :param iModel: fitted ensemble model with estimators_
+    :param iFeatures: array of features
+    :return: array (rows x estimators) of the prediction of each estimator
+    """
+    return np.column_stack([lEstimator.predict(iFeatures) for lEstimator in iModel.estimators_])
+
+
+def init_pool_worker(iModelFactory, iSampleFunction, iFeatures, iFeaturesShape, iTargets, iPredictions,
+                     iPredictionsShape):
+    """
+
+    Initializer of pool workers : numpy views on shared arrays (no copy of features)
+    """
+    gWorkerArrays['model_factory'] = iModelFactory
+    gWorkerArrays['sample_function'] = iSampleFunction
+    gWorkerArrays['features'] = np.frombuffer(iFeatures, dtype=np.float64).reshape(iFeaturesShape)
+    gWorkerArrays['targets'] = np.frombuffer(iTargets, dtype=np.float64)
+    gWorkerArrays['predictions'] = np.frombuffer(iPredictions, dtype=np.float64).reshape(iPredictionsShape)
+
+
+def fit_predict_nodes(iNodeRows):
+    """
+
+    Fits a model for each node and writes its predictions (and samples) in the shared predictions array
+    :param iNodeRows: list of (train start, test start, test end) rows of each node
+    :return: number of fitted nodes
+    """
+    lFeatures = gWorkerArrays['features']
+    lTargets = gWorkerArrays['targets']
+    lPredictions = gWorkerArrays['predictions']
+    for lTrStart, lTsStart, lTsEnd in iNodeRows:
+        lModel = gWorkerArrays['model_factory']()
+        lModel.fit(lFeatures[lTrStart:lTsStart], lTargets[lTrStart:lTsStart])
+        lPredictions[lTsStart:lTsEnd, 0] = lModel.predict(lFeatures[lTsStart:lTsEnd])
+        if gWorkerArrays['sample_function'] is not None:
+            lPredictions[lTsStart:lTsEnd, 1:] = gWorkerArrays['sample_function'](lModel, lFeatures[lTsStart:lTsEnd])
+    return len(iNodeRows)
+
+
+class cHtsForecaster:
+    def __init__(self, iModelFactory, iFeatureCols, iTargetCol, iDateCol, iHierarchyOrder, iForecastCol='Forecast',
+                 iNbJobs=None, iChunkRows=10000, iSampleFunction=None, iNbSamples=0):
+        """
+
+        :param iModelFactory: picklable function returning a new model with fit / predict (e.g.
+        functools.partial(RandomForestRegressor, n_jobs=1))
+        :param iFeatureCols: list of feature columns
+        :param iTargetCol: target column
+        :param iDateCol: date column
+        :param iHierarchyOrder: a dict with names and level values : 0 is the base level (most granular)
+        :param iForecastCol: name of forecast column of results
+        :param iNbJobs: number of processes (all cpus if None, no pool if 1)
+        :param iChunkRows: minimum number of rows of each task : small nodes are batched together
+        :param iSampleFunction: picklable function(fitted model, features) returning an array (rows x iNbSamples) of
+        sample paths (e.g. predict_estimators), added as columns iForecastCol + '_s' + sample number
+        :param iNbSamples: number of samples given by iSampleFunction
+        """
+        self.mModelFactory = iModelFactory
+        self.mFeatureCols = iFeatureCols
+        self.mTargetCol = iTargetCol
+        self.mDateCol = iDateCol
+        self.mHierarchyOrder = iHierarchyOrder
+        self.mRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+        self.mForecastCol = iForecastCol
+        self.mNbJobs = iNbJobs if iNbJobs is not None else multiprocessing.cpu_count()
+        self.mChunkRows = iChunkRows
+        self.mSampleFunction = iSampleFunction
+        self.mNbSamples = iNbSamples if iSampleFunction is not None else 0
+
+    def create_node_rows(self, iLevelDfDictTr, iLevelDfDictTs):
+        """
+
+        Stacks rows of all levels, sorted by node then training rows first
+        :return: sorted rows DF (level, node code, is test, position in its level DF), list of (train start,
+        test start, test end) of each node with training and testing rows
+        """
+        lRows = []
+        lNodeOffset = 0
+        for level in sorted(self.mRevHierarchyOrder.keys()):
+            lCol = self.mRevHierarchyOrder[level]
+            # Categorical level columns with the same categories are factorized on their codes
+            lCodes, lUniques = pd.factorize(pd.concat([iLevelDfDictTr[level].loc[:, lCol],
+                                                       iLevelDfDictTs[level].loc[:, lCol]], ignore_index=True))
+            lNbTr = iLevelDfDictTr[level].shape[0]
+            lRows.append(pd.DataFrame({'level': level, 'node': lCodes + lNodeOffset,
+                                       'is_test': np.arange(len(lCodes)) >= lNbTr,
+                                       'position': np.concatenate([np.arange(lNbTr),
+                                                                   np.arange(len(lCodes) - lNbTr)])}))
+            lNodeOffset += len(lUniques)
+        oRows = pd.concat(lRows, ignore_index=True).sort_values(['node', 'is_test'], kind='mergesort')
+
+        lNodes = oRows.loc[:, 'node'].values
+        lTrStarts = np.searchsorted(lNodes, np.arange(lNodeOffset), side='left')
+        lTsEnds = np.searchsorted(lNodes, np.arange(lNodeOffset), side='right')
+        lTsStarts = lTrStarts + np.bincount(lNodes[~oRows.loc[:, 'is_test'].values], minlength=lNodeOffset)
+        lFitted = (lTsStarts > lTrStarts) & (lTsEnds > lTsStarts)
+        oNodeRows = list(zip(lTrStarts[lFitted], lTsStarts[lFitted], lTsEnds[lFitted]))
+
+        return oRows.reset_index(drop=True), oNodeRows
+
+    def create_tasks(self, iNodeRows):
+        """
+
+        :param iNodeRows: list of (train start, test start, test end) of each node
+        :return: list of tasks (list of nodes with at least self.mChunkRows rows)
+        """
+        oTasks = []
+        lCurrentTask = []
+        lCurrentRows = 0
+        for lNodeRows in iNodeRows:
+            lCurrentTask.append(lNodeRows)
+            lCurrentRows += lNodeRows[2] - lNodeRows[0]
+            if lCurrentRows >= self.mChunkRows:
+                oTasks.append(lCurrentTask)
+                lCurrentTask = []
+                lCurrentRows = 0
+        if len(lCurrentTask) > 0:
+            oTasks.append(lCurrentTask)
+        return oTasks
+
+    def computeBaseForecasts(self, iLevelDfDictTr, iLevelDfDictTs):
+        """
+
+        Fits a model for each node of each level on its training rows and predicts its testing rows
+        :param iLevelDfDictTr: dict of training DFs (1 per level) with date, level, feature and target columns
+        :param iLevelDfDictTs: dict of testing DFs (same columns)
+        :return: dict of testing DFs with date, level, target, forecast (and sample) columns (iLevelDfDict of
+        cHtsOptimizer)
+        """
+        lRows, lNodeRows = self.create_node_rows(iLevelDfDictTr, iLevelDfDictTs)
+
+        # Features and targets in the order of sorted rows
+        lFeatures = np.zeros((lRows.shape[0], len(self.mFeatureCols)))
+        lTargets = np.zeros(lRows.shape[0])
+        for level in sorted(self.mRevHierarchyOrder.keys()):
+            for lIsTest, lLevelDf in [(False, iLevelDfDictTr[level]), (True, iLevelDfDictTs[level])]:
+                lMask = ((lRows.loc[:, 'level'] == level) & (lRows.loc[:, 'is_test'] == lIsTest)).values
+                lPositions = lRows.loc[lMask, 'position'].values
+                lFeatures[lMask] = lLevelDf.loc[:, self.mFeatureCols].values[lPositions]
+                lTargets[lMask] = lLevelDf.loc[:, self.mTargetCol].values[lPositions]
+
+        lRawFeatures, lFeatures = create_shared_array(lFeatures)
+        lRawTargets, lTargets = create_shared_array(lTargets)
+        lRawPredictions, lPredictions = create_shared_array(np.full((lRows.shape[0], 1 + self.mNbSamples), np.nan))
+        lInitArgs = (self.mModelFactory, self.mSampleFunction, lRawFeatures, lFeatures.shape, lRawTargets,
+                     lRawPredictions, lPredictions.shape)
+
+        lTasks = self.create_tasks(lNodeRows)
+        if self.mNbJobs == 1:
+            init_pool_worker(*lInitArgs)
+            for lTask in lTasks:
+                fit_predict_nodes(lTask)
+        else:
+            lPool = multiprocessing.Pool(self.mNbJobs, initializer=init_pool_worker, initargs=lInitArgs)
+            try:
+                lPool.map(fit_predict_nodes, lTasks, chunksize=1)
+            finally:
+                lPool.close()
+                lPool.join()
+
+        # Repack predictions in testing DFs
+        oLevelDfDict = {}
+        for level in sorted(self.mRevHierarchyOrder.keys()):
+            lMask = ((lRows.loc[:, 'level'] == level) & lRows.loc[:, 'is_test']).values
+            lLevelDf = iLevelDfDictTs[level].loc[:, [self.mDateCol, self.mRevHierarchyOrder[level], self.mTargetCol]]
+            lForecasts = np.zeros((lLevelDf.shape[0], 1 + self.mNbSamples))
+            lForecasts[lRows.loc[lMask, 'position'].values] = lPredictions[lMask]
+            lLevelDf.loc[:, self.mForecastCol] = lForecasts[:, 0]
+            for k in range(self.mNbSamples):
+                lLevelDf.loc[:, self.mForecastCol + '_s' + str(k)] = lForecasts[:, k + 1]
+            oLevelDfDict[level] = lLevelDf
+        return oLevelDfDict
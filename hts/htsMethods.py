@@ -1,233 +1,810 @@
+import hashlib
+
 import numpy as np
 import pandas as pd
+import scipy.sparse as sps
 
 from hierarchyHandler import cHierarchyHandler
+from htsSolvers import cOlsReconciliationSolver, cWeightedReconciliationSolver, create_structural_weights, \
+    create_variance_weights, create_shrinkage_covariance
 
 
 class cHtsOptimizer(cHierarchyHandler):
     def __init__(self, iLevelDfDict, iInitialForecastCol='Forecast', iDateCol=None, iHierarchyDf=None,
-                 iHierarchyOrder=None):
+                 iHierarchyOrder=None, iProfiler=None):
         """
 
         :param iHierarchyDf: a Df with the hierarchy
         :param iHierarchyOrder: a dict with names and level values : 0 is the base level (most granular)
+        :param iProfiler: cHtsProfiler recording each stage of methods (no instrumentation if None)
         """
-        cHierarchyHandler.__init__(self, iHierarchyDf, iHierarchyOrder)
-        self.mStructure = self.create_structure()
+        cHierarchyHandler.__init__(self, iHierarchyDf, iHierarchyOrder, iProfiler)
+        self.mSummingMatrix, self.mNodeIndex = self.create_sparse_summing_matrix()
+        self.mParentIndex = self.get_compact_structure().mParentIndex
+        self.mOlsSolvers = {}
+        self.mWeightedSolvers = {}
         self.mLevelDfDict = iLevelDfDict
         self.mInitialForecastCol = iInitialForecastCol
         self.mDateCol = iDateCol
+        # Rows of each level in the (nodes x dates) forecast matrix
+        self.mLevelSlices = dict((level, self.get_compact_structure().get_level_slice(level))
+                                 for level in self.get_compact_structure().mLevels)
+        # Incremental mode : last projection matrix of each method and running sums of historical proportions
+        self.mProjections = {}
+        self.mProportionSums = None
+        with self.profile('cHtsOptimizer', 'create_level_aggregation_matrices'):
+            self.mLevelAggregationMatrices = self.create_level_aggregation_matrices()
+        with self.profile('cHtsOptimizer', 'create_forecast_cells') as lStage:
+            self.mDates, self.mLevelCells = self.create_forecast_cells()
+            lStage.add_counts(nodes=len(self.mNodeIndex), dates=len(self.mDates),
+                              rows=sum(len(lRows) for lRows, lCols in self.mLevelCells.values()))
 
-    def computeTopDownHistoricalProportions(self, iLevelDfDictForProp, iTsCol=None):
+    def create_level_aggregation_matrices(self):
         """
 
-        :param iTscol: string of the column to be used to compute proportions
-        With forecast DFs, computes the 2 kinds of proportions :
-        :return: average of historical proportions, proportion of historical average
+        :return: dict {level : sparse matrix (nodes of level x nodes of its children level) summing children}
+        """
+        lStructure = self.get_compact_structure()
+        return dict((level, lStructure.create_aggregation_matrix(level)) for level in lStructure.mChildLevels.keys())
+
+    def create_forecast_cells(self, iLevelDfDict=None):
+        """
+
+        Locates each row of the level DFs in the (nodes x dates) forecast matrix
+        :param iLevelDfDict: dict of DFs (self.mLevelDfDict if None)
+        :return: dates (columns of forecast matrix), dict {level : (rows in matrix, columns in matrix)}
+        """
+        if iLevelDfDict is None:
+            iLevelDfDict = self.mLevelDfDict
+        if self.mDateCol is not None:
+            oDates = pd.Index(np.unique(np.concatenate(
+                [iLevelDfDict[level].loc[:, self.mDateCol].values for level in self.mLevelSlices.keys()])))
+
+        oLevelCells = {}
+        for level, lSlice in self.mLevelSlices.items():
+            lLevelDf = iLevelDfDict[level]
+            lRows = self.get_node_registry().encode(level, lLevelDf.loc[:, self.mRevHierarchyOrder[level]])
+            if (lRows < 0).any():
+                raise ValueError('DF of level ' + str(level) + ' contains nodes which are not in the hierarchy')
+            if self.mDateCol is not None:
+                lCols = oDates.get_indexer(lLevelDf.loc[:, self.mDateCol].values)
+            else:
+                # No date column : rows of each node are assumed to be in the same order
+                lCols = lLevelDf.groupby(self.mRevHierarchyOrder[level]).cumcount().values
+            oLevelCells[level] = (lRows + lSlice.start, lCols)
+
+        if self.mDateCol is None:
+            oDates = pd.RangeIndex(max([lCols.max() + 1 for lRows, lCols in oLevelCells.values()]))
+
+        return oDates, oLevelCells
+
+    def create_forecast_matrix(self, iCols=None, iLevelDfDict=None, iForecastCells=None):
+        """
+
+        :param iCols: column (or list of columns) of level DFs to unpack (initial forecast column if None)
+        :param iLevelDfDict: dict of DFs to unpack (self.mLevelDfDict if None)
+        :param iForecastCells: dates and cells of iLevelDfDict if already computed (see create_forecast_cells)
+        :return: array (nodes x dates) or (nodes x dates x columns) if iCols is a list, rows in the order of
+        self.mNodeIndex, missing values are 0
+        """
+        if iCols is None:
+            iCols = self.mInitialForecastCol
+        if iLevelDfDict is None:
+            iLevelDfDict = self.mLevelDfDict
+            lDates, lLevelCells = self.mDates, self.mLevelCells
+        elif iForecastCells is not None:
+            lDates, lLevelCells = iForecastCells
+        else:
+            lDates, lLevelCells = self.create_forecast_cells(iLevelDfDict)
+        if isinstance(iCols, list):
+            oForecasts = np.zeros((len(self.mNodeIndex), len(lDates), len(iCols)))
+        else:
+            oForecasts = np.zeros((len(self.mNodeIndex), len(lDates)))
+        for level, (lRows, lCols) in lLevelCells.items():
+            oForecasts[lRows, lCols] = iLevelDfDict[level].loc[:, iCols].values
+        return oForecasts
+
+    def create_level_df_dict(self, iForecasts, iCols, iLevelDfDict=None, iLevelCells=None):
+        """
+
+        :param iForecasts: array (nodes x dates) or (nodes x dates x columns) of forecasts
+        :param iCols: name (or list of names if iForecasts has 3 dimensions) of the columns to add
+        :param iLevelDfDict: dict of DFs to copy (self.mLevelDfDict if None)
+        :param iLevelCells: cells of iLevelDfDict in iForecasts (see create_forecast_cells)
+        :return: copy of the dict of DFs with forecasts in iCols
+        """
+        if iLevelDfDict is None:
+            iLevelDfDict, iLevelCells = self.mLevelDfDict, self.mLevelCells
+        oLevelDfDict = {}
+        for level, (lRows, lCols) in iLevelCells.items():
+            lLevelDf = iLevelDfDict[level].copy()
+            if isinstance(iCols, list):
+                for k, col in enumerate(iCols):
+                    lLevelDf.loc[:, col] = iForecasts[lRows, lCols, k]
+            else:
+                lLevelDf.loc[:, iCols] = iForecasts[lRows, lCols]
+            oLevelDfDict[level] = lLevelDf
+        return oLevelDfDict
+
+    def get_result_cols(self, iForecastCols, iPrefix):
+        """
+
+        :param iForecastCols: list of forecast columns (initial forecast column if None)
+        :param iPrefix: prefix string to add to forecast cols
+        :return: name (or list of names) of result columns
+        """
+        if iForecastCols is None:
+            return self.mInitialForecastCol + "_" + iPrefix
+        return [col + "_" + iPrefix for col in iForecastCols]
+
+    def create_proportion_vector(self, iProp):
+        """
+
+        :param iProp: dict of proportions {parent node : {child node : proportion}}, nodes are (level, label) (see
+        create_historical_proportions). Dicts keyed by labels {parent label : {child label : proportion}} are
+        accepted when no (parent label, child label) pair is used at several levels.
+        :return: array with the proportion of each node in its parent (nan for nodes of the highest level)
+        """
+        oProp = np.repeat(np.nan, len(self.mNodeIndex))
+        lChildren = np.flatnonzero(self.mParentIndex >= 0)
+        lParents = self.mParentIndex[lChildren]
+        lNodes = self.mNodeIndex.values
+        if len(lChildren) == 0 or lNodes[lParents[0]] in iProp:
+            oProp[lChildren] = [iProp[lNodes[p]][lNodes[c]] for p, c in zip(lParents, lChildren)]
+            return oProp
+
+        lLabels = self.mNodeIndex.get_level_values(1).values
+        if pd.DataFrame({'parent': lLabels[lParents], 'child': lLabels[lChildren]}).duplicated().any():
+            raise ValueError('Proportions keyed by labels are ambiguous : a (parent, child) pair of labels is used at '
+                             'several levels, use (level, label) nodes as keys')
+        oProp[lChildren] = [iProp[lLabels[p]][lLabels[c]] for p, c in zip(lParents, lChildren)]
+        return oProp
+
+    def get_allocation_levels(self, iFromLevel):
+        """
+
+        :param iFromLevel: level whose forecasts are allocated
+        :return: levels on the path of parent levels from the base level to iFromLevel (excluded), from highest to
+        lowest. Other levels of grouped hierarchies are not on this path : they are summed from the base level.
+        Raises ValueError if iFromLevel is not a parent level (or parent of parent...) of the base level
+        """
+        lParentLevels = self.get_compact_structure().mParentLevels
+        oLevels = []
+        level = 0
+        while level != iFromLevel:
+            if level not in lParentLevels:
+                raise ValueError('Level ' + str(iFromLevel) + ' is not on the path of parent levels of the base level')
+            oLevels.append(level)
+            level = lParentLevels[level]
+        return oLevels[::-1]
+
+    def allocate_top_down(self, iForecasts, iPropVector, iFromLevel):
+        """
+
+        :param iForecasts: array (nodes x ...) of forecasts, modified in place
+        :param iPropVector: array of proportion of each node in its parent (or array (nodes x ...) of proportions
+        for each date, see create_forecast_proportions)
+        :param iFromLevel: forecasts of this level are allocated down to the base level (following parent levels),
+        other levels are left unchanged (see aggregate_bottom_up)
+        :return: iForecasts
+        """
+        lPropShape = (-1,) + (1,) * (iForecasts.ndim - 1) if iPropVector.ndim == 1 else iPropVector.shape
+        for level in self.get_allocation_levels(iFromLevel):
+            lChildren = self.mLevelSlices[level]
+            iForecasts[lChildren] = iForecasts[self.mParentIndex[lChildren]] * iPropVector[lChildren].reshape(
+                (-1,) + lPropShape[1:])
+        return iForecasts
+
+    def create_forecast_proportions(self, iForecasts):
+        """
+
+        Share of the forecast of each node in the sum of forecasts of its siblings (children of its parent in the
+        same level), for each date. Siblings with a zero sum share it equally.
+        :param iForecasts: array (nodes x ...) of base forecasts
+        :return: array (nodes x ...) of proportions (nan for nodes of the highest level)
         """
+        lStructure = self.get_compact_structure()
+        oProp = np.repeat(np.nan, iForecasts.size).reshape(iForecasts.shape)
+        for level, lParentLevel in lStructure.mParentLevels.items():
+            lChildren = self.mLevelSlices[level]
+            lParents = self.mParentIndex[lChildren] - self.mLevelSlices[lParentLevel].start
+            lNbChildren = lChildren.stop - lChildren.start
+            lSiblingsMatrix = sps.csr_matrix((np.ones(lNbChildren), (lParents, np.arange(lNbChildren))),
+                                             shape=(self.mLevelSlices[lParentLevel].stop -
+                                                    self.mLevelSlices[lParentLevel].start, lNbChildren))
+            lForecasts = iForecasts[lChildren].reshape(lNbChildren, -1)
+            lSiblingsSums = lSiblingsMatrix.dot(lForecasts)[lParents]
+            lSiblingsCounts = np.bincount(lParents)[lParents].reshape(-1, 1)
+            lNonZero = lSiblingsSums != 0
+            oProp[lChildren] = np.where(lNonZero, lForecasts / np.where(lNonZero, lSiblingsSums, 1.),
+                                        1. / lSiblingsCounts).reshape(oProp[lChildren].shape)
+        return oProp
+
+    def aggregate_bottom_up(self, iForecasts, iFromLevel):
+        """
+
+        :param iForecasts: array (nodes x ...) of forecasts, modified in place
+        :param iFromLevel: forecasts of this level are summed into all higher levels (following children levels)
+        :return: iForecasts
+        """
+        lChildLevels = self.get_compact_structure().mChildLevels
+        # Levels whose children level is already aggregated, from lowest to highest
+        lAggregatedLevels = set([iFromLevel])
+        for level in sorted(lChildLevels.keys()):
+            if lChildLevels[level] in lAggregatedLevels and level != iFromLevel:
+                lChildren = iForecasts[self.mLevelSlices[lChildLevels[level]]]
+                iForecasts[self.mLevelSlices[level]] = self.mLevelAggregationMatrices[level].dot(
+                    lChildren.reshape(lChildren.shape[0], -1)).reshape((-1,) + lChildren.shape[1:])
+                lAggregatedLevels.add(level)
+        return iForecasts
+
+    def accumulate_proportion_sums(self, iNodeValues, iSums=None):
+        """
+
+        Adds the sums needed by historical proportions for a block of dates
+        :param iNodeValues: array (nodes x dates) of historical values, rows in the order of self.mNodeIndex
+        :param iSums: sums of previous blocks (None for the first block)
+        :return: for each (child, parent) link : sum of child / parent ratios where parent is not 0, number of such
+        dates, and for each node : sum of values
+        """
+        lStructure = self.get_compact_structure()
+        lChildren = iNodeValues[lStructure.mEdgeChildren]
+        lParents = iNodeValues[lStructure.mEdgeParents]
+        lNonZero = lParents != 0
+        lRatios = np.where(lNonZero, lChildren / np.where(lNonZero, lParents, 1.), 0.)
+
+        oSums = (lRatios.sum(axis=1), lNonZero.sum(axis=1), iNodeValues.sum(axis=1))
+        if iSums is not None:
+            oSums = tuple(lSum + lNewSum for lSum, lNewSum in zip(iSums, oSums))
+        return oSums
+
+    def create_historical_proportions(self, iSums):
+        """
+
+        :param iSums: sums given by accumulate_proportion_sums
+        :return: average of historical proportions, proportion of historical average : dicts {parent node : {child
+        node : proportion}}, nodes are (level, label)
+        """
+        lRatioSums, lRatioCounts, lNodeSums = iSums
+        lStructure = self.get_compact_structure()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lAvgHistProp = np.where(lRatioCounts > 0, lRatioSums / np.maximum(lRatioCounts, 1), np.nan)
+            # Assume parent is not zero mean
+            lPropHistAvg = lNodeSums[lStructure.mEdgeChildren] / lNodeSums[lStructure.mEdgeParents]
+
+        # Keyed by (level, label) nodes : a label used at several levels is a different node at each level
+        lNodes = self.mNodeIndex.values
         oAvgHistProp = {}
         oPropHistAvg = {}
-        if iTsCol is not None:
-            for level in self.mStructure.keys():
-                if level > 0:
-                    for col in self.mStructure[level].keys():
-                        oAvgHistProp[col] = {}
-                        oPropHistAvg[col] = {}
-                        for col1 in self.mStructure[level][col]:
-                            lYxx = iLevelDfDictForProp[level - 1].groupby(self.mRevHierarchyOrder[level - 1]).get_group(
-                                col1).loc[:, iTsCol].values
-                            lYt = iLevelDfDictForProp[level].groupby(self.mRevHierarchyOrder[level]).get_group(col).loc[
-                                  :, iTsCol].values
-                            # Trick if there is a zero in lYt
-                            oAvgHistProp[col][col1] = (lYxx[np.where(lYt != 0)] / lYt[np.where(lYt != 0)]).mean()
-                            # Assume lYt is not zero mean
-                            oPropHistAvg[col][col1] = lYxx.mean() / lYt.mean()
+        for col, col1, lAvg, lProp in zip(lNodes[lStructure.mEdgeParents], lNodes[lStructure.mEdgeChildren],
+                                          lAvgHistProp, lPropHistAvg):
+            if col not in oAvgHistProp:
+                oAvgHistProp[col] = {}
+                oPropHistAvg[col] = {}
+            oAvgHistProp[col][col1] = lAvg
+            oPropHistAvg[col][col1] = lProp
 
         return oAvgHistProp, oPropHistAvg
 
-    def computeTopDownForecasts(self, iProp, iPrefix):
+    def computeTopDownHistoricalProportions(self, iLevelDfDictForProp, iTsCol=None):
+        """
+
+        :param iTscol: string of the column to be used to compute proportions
+        With forecast DFs, computes the 2 kinds of proportions (children and parents are aligned on dates) :
+        :return: average of historical proportions, proportion of historical average
+        """
+        if iTsCol is None:
+            return {}, {}
+
+        with self.profile('computeTopDownHistoricalProportions', 'create_forecast_matrix') as lStage:
+            lNodeValues = self.create_forecast_matrix(iTsCol, iLevelDfDictForProp)
+            lStage.add_counts(nodes=lNodeValues.shape[0], dates=lNodeValues.shape[1])
+        with self.profile('computeTopDownHistoricalProportions', 'accumulate_proportion_sums') as lStage:
+            lSums = self.accumulate_proportion_sums(lNodeValues)
+            lStage.add_counts(edges=len(lSums[0]))
+        with self.profile('computeTopDownHistoricalProportions', 'create_historical_proportions'):
+            return self.create_historical_proportions(lSums)
+
+    def computeTopDownHistoricalProportionsFromChunks(self, iChunks, iTsCol, iDateCol=None):
+        """
+
+        Streaming version of computeTopDownHistoricalProportions : history is never fully loaded in memory
+        :param iChunks: iterable of DFs of base level history (e.g. tsUtils.read_chunks), with the base level column,
+        date column and iTsCol. Chunks must be sorted by date : rows of the last date of a chunk are kept for the
+        next one so that each date is complete
+        :param iTsCol: string of the column to be used to compute proportions
+        :param iDateCol: date column (self.mDateCol if None)
+        :return: average of historical proportions, proportion of historical average (empty dicts if there is no
+        history)
+        """
+        if iDateCol is None:
+            iDateCol = self.mDateCol
+        lSums = None
+        lCarry = None
+        for lChunk in iChunks:
+            if lCarry is not None:
+                lChunk = pd.concat([lCarry, lChunk])
+            lIsLastDate = (lChunk.loc[:, iDateCol] == lChunk.loc[:, iDateCol].max()).values
+            lCarry = lChunk.loc[lIsLastDate, :]
+            if not lIsLastDate.all():
+                lSums = self.accumulate_chunk_proportion_sums(lChunk.loc[~lIsLastDate, :], iTsCol, iDateCol, lSums)
+        if lCarry is not None and lCarry.shape[0] > 0:
+            lSums = self.accumulate_chunk_proportion_sums(lCarry, iTsCol, iDateCol, lSums)
+        if lSums is None:
+            # No history, as computeTopDownHistoricalProportions without iTsCol
+            return {}, {}
+
+        with self.profile('computeTopDownHistoricalProportionsFromChunks', 'create_historical_proportions'):
+            return self.create_historical_proportions(lSums)
+
+    def accumulate_chunk_proportion_sums(self, iDf, iTsCol, iDateCol, iSums):
+        """
+
+        Unpacks and accumulates a chunk of computeTopDownHistoricalProportionsFromChunks (2 profiled stages)
+        :param iDf: DF of base level values of complete dates
+        :param iTsCol: column of values
+        :param iDateCol: date column
+        :param iSums: sums of previous chunks (None for the first chunk)
+        :return: sums given by accumulate_proportion_sums
+        """
+        with self.profile('computeTopDownHistoricalProportionsFromChunks', 'create_node_values_from_base') as lStage:
+            lNodeValues = self.create_node_values_from_base(iDf, iTsCol, iDateCol)
+            lStage.add_counts(rows=iDf.shape[0], nodes=lNodeValues.shape[0], dates=lNodeValues.shape[1])
+        with self.profile('computeTopDownHistoricalProportionsFromChunks', 'accumulate_proportion_sums'):
+            return self.accumulate_proportion_sums(lNodeValues, iSums)
+
+    def create_node_values_from_base(self, iDf, iTsCol, iDateCol):
+        """
+
+        :param iDf: DF of base level values (base level column, date column and iTsCol)
+        :param iTsCol: column of values
+        :param iDateCol: date column
+        :return: array (nodes x dates of iDf) of values summed at all levels, missing base values are 0
+        """
+        lRegistry = self.get_node_registry()
+        lRows = lRegistry.encode(0, iDf.loc[:, self.mRevHierarchyOrder[0]])
+        if (lRows < 0).any():
+            raise ValueError('DF contains base nodes which are not in the hierarchy')
+        lCols, lDates = pd.factorize(iDf.loc[:, iDateCol].values)
+        lBaseValues = sps.coo_matrix((iDf.loc[:, iTsCol].values.astype(np.float64), (lRows, lCols)),
+                                     shape=(len(lRegistry.mLabelIndexes[0]), len(lDates))).toarray()
+        return self.mSummingMatrix.dot(lBaseValues)
+
+    def reconcile_forecast_matrix(self, iForecasts, iMethod, iProp=None, iMidLevel=None, iSolver='sparse'):
+        """
+
+        :param iForecasts: array (nodes x ...) of forecasts, all trailing dimensions (dates, columns, samples) are
+        reconciled at once
+        :param iMethod: 'BU', 'TD', 'TDFP' (TD with forecast proportions), 'MO' or 'OC'
+        :param iProp: proportions for TD and MO (dict {parent : {child : proportion}} or array given by
+        create_proportion_vector)
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC ('sparse' or 'dense', see get_ols_solver, or a solver given by
+        get_weighted_solver)
+        :return: array of reconciled forecasts with the same shape
+        """
+        if iMethod == 'OC':
+            if hasattr(iSolver, 'reconcile'):
+                return iSolver.reconcile(iForecasts)
+            return self.get_ols_solver(iSolver).reconcile(iForecasts)
+
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+        oForecasts = iForecasts.copy()
+        if iMethod == 'BU':
+            self.aggregate_bottom_up(oForecasts, 0)
+        elif iMethod in ['TD', 'TDFP', 'MO']:
+            # Allocation from the highest (or mid) level down to the base level, then sums from the base level : all
+            # levels of grouped hierarchies are coherent, not only the ones on the allocation path of base nodes
+            if iMethod == 'TDFP':
+                iProp = self.create_forecast_proportions(iForecasts)
+            self.allocate_top_down(oForecasts, iProp, iMidLevel if iMethod == 'MO' else max(self.mLevelSlices.keys()))
+            self.aggregate_bottom_up(oForecasts, 0)
+        else:
+            raise ValueError('Unknown reconciliation method : ' + str(iMethod))
+        return oForecasts
+
+    def computeReconciledForecastArray(self, iForecasts, iMethod, iProp=None, iMidLevel=None, iSolver='sparse'):
+        """
+        Reconciles many forecast sets (quantiles, models, sample paths, ...) in one pass
+        :param iForecasts: array (samples x nodes x dates), nodes in the order of self.mNodeIndex and dates in the
+        order of self.mDates
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :return: array (samples x nodes x dates) of reconciled forecasts
+        """
+        lForecasts = np.moveaxis(np.asarray(iForecasts, dtype=np.float64), 1, 0)
+        oForecasts = self.reconcile_forecast_matrix(lForecasts, iMethod, iProp, iMidLevel, iSolver)
+        return np.moveaxis(oForecasts, 0, 1)
+
+    def compute_reconciled_level_dfs(self, iMethodName, iMethod, iPrefix, iForecastCols, iProp=None, iMidLevel=None,
+                                     iSolver='sparse'):
+        """
+
+        Unpacks forecasts of level DFs, reconciles them and repacks them into level DFs (3 profiled stages)
+        :param iMethodName: name of the calling method (for the profiler)
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iPrefix: prefix string to add to forecast col
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :return: copy of self.mLevelDfDict with reconciled forecasts cols
+        """
+        with self.profile(iMethodName, 'create_forecast_matrix') as lStage:
+            lForecasts = self.create_forecast_matrix(iForecastCols)
+            lStage.add_counts(nodes=lForecasts.shape[0], dates=lForecasts.shape[1])
+        with self.profile(iMethodName, 'reconcile') as lStage:
+            lForecasts = self.reconcile_forecast_matrix(lForecasts, iMethod, iProp, iMidLevel, iSolver)
+            lStage.add_counts(nnz=self.mSummingMatrix.nnz)
+        with self.profile(iMethodName, 'create_level_df_dict') as lStage:
+            oLevelDfDict = self.create_level_df_dict(lForecasts, self.get_result_cols(iForecastCols, iPrefix))
+            lStage.add_counts(rows=sum(lLevelDf.shape[0] for lLevelDf in oLevelDfDict.values()))
+        return oLevelDfDict
+
+    def computeTopDownForecasts(self, iProp, iPrefix, iForecastCols=None):
         """
         TOP DOWN forecast : forecast is taken at maximum level and then allocated to lower levels according to iProp
         :param iProp: proportion used to computes TD
         :param iPrefix: prefix string to add to forecast col
-        :param iInitialForecastCol: initial forecast column
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
         :return: same dict of Dfs with updated forecasts cols for the TD approach
         """
-        # Copy initial forecasts (forecast for highest level will be unchanged)
-        oLevelDfDictResultsTD = self.mLevelDfDict.copy()
-        lLevelsReversed = sorted(self.mStructure.keys(), reverse=True)
+        # Forecast for highest level is initial forecast (because it is TOP DOWN approach)
+        return self.compute_reconciled_level_dfs('computeTopDownForecasts', 'TD', iPrefix, iForecastCols, iProp=iProp)
 
-        # Highest level (less granular)
-        lHighestLevel = lLevelsReversed[0]
+    def computeTopDownForecastProportions(self, iPrefix='TDFP', iForecastCols=None):
+        """
+        TOP DOWN forecast with forecast proportions (Athanasopoulos et al., 2009) : forecast is taken at maximum level
+        and allocated to lower levels according to the share of the base forecast of each node in its siblings
+        :param iPrefix: prefix string to add to forecast col
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
+        :return: same dict of Dfs with updated forecasts cols for the TD approach
+        """
+        return self.compute_reconciled_level_dfs('computeTopDownForecastProportions', 'TDFP', iPrefix, iForecastCols)
 
-        # Forecast for highest level is initial forecast (because it is TOP DOWN approach)
-        current_df = self.mLevelDfDict[lHighestLevel].copy()
-        current_df.loc[:, self.mInitialForecastCol + "_" + iPrefix] = current_df.loc[:, self.mInitialForecastCol]
-        oLevelDfDictResultsTD[lHighestLevel] = current_df
-
-        # From less to most granular
-        for level in lLevelsReversed:
-            if level > 0:
-                results_current_lvl = []
-                for col in self.mStructure[level].keys():
-                    l_new_TD_forecast_df = oLevelDfDictResultsTD[level].groupby(
-                        self.mRevHierarchyOrder[level]).get_group(
-                        col).copy()
-                    # Get the forecast for the +1 level
-                    for col1 in self.mStructure[level][col]:
-                        # Replace the forecast for the current level by forecast lvl+1 * proportion
-                        l_new_TD_forecast_df2 = oLevelDfDictResultsTD[level - 1].groupby(
-                            self.mRevHierarchyOrder[level - 1], as_index=False).get_group(
-                            col1).copy()
-                        l_new_TD_forecast_df2.loc[:,
-                        self.mInitialForecastCol + "_" + iPrefix] = l_new_TD_forecast_df.loc[:,
-                                                                    self.mInitialForecastCol + "_" + iPrefix].values * \
-                                                                    iProp[col][col1]
-                        results_current_lvl.append(l_new_TD_forecast_df2)
-                oLevelDfDictResultsTD[level - 1] = pd.concat(results_current_lvl)
-
-        return oLevelDfDictResultsTD
-
-    def computeBottomUpForecasts(self, iPrefix='BU'):
+    def computeBottomUpForecasts(self, iPrefix='BU', iForecastCols=None):
         """
         Bottom up forecasts : forecast are taken at lower levels and aggregated at upper ones
-        :param iInitialForecastCol: initial forecast column
         :param iPrefix: prefix string to add to forecast col
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
         :return: same dict of Dfs with updated forecasts cols for the BU approach
         """
-        # Copy initial forecasts (forecast for lowest level will be unchanged)
-        oLevelDfDictResultsBU = self.mLevelDfDict.copy()
-        lLevelsSorted = sorted(self.mStructure.keys(), reverse=False)
+        # Forecast for lowest level is initial forecast (because it is BOTTOM UP approach)
+        return self.compute_reconciled_level_dfs('computeBottomUpForecasts', 'BU', iPrefix, iForecastCols)
 
-        # Lowest level (most granular)
-        lLowestLevel = lLevelsSorted[0]
+    def computeMiddleOutForecasts(self, iProp, iMidLevel, iPrefix='MO', iForecastCols=None):
+        """
 
-        # Forecast for lowest level is initial forecast (because it is BOTTOM UP approach)
-        current_df = self.mLevelDfDict[lLowestLevel].copy()
-        current_df.loc[:, self.mInitialForecastCol + "_" + iPrefix] = current_df.loc[:, self.mInitialForecastCol]
-        oLevelDfDictResultsBU[lLowestLevel] = current_df
-
-        for level in lLevelsSorted:
-            if level > 0:
-                results_current_lvl = []
-                for col in self.mStructure[level].keys():
-                    l_new_BU_forecast_df = oLevelDfDictResultsBU[level - 1].loc[
-                                           oLevelDfDictResultsBU[level - 1][self.mRevHierarchyOrder[level - 1]].isin(
-                                               self.mStructure[level][col]), :]
-                    l_new_TD_forecast_df2 = oLevelDfDictResultsBU[level].groupby(
-                        self.mRevHierarchyOrder[level]).get_group(
-                        col).copy()
-                    # print l_new_BU_forecast_df.groupby(iDateCol)[iInitialForecastCol + "_" + iPrefix].sum().head()
-                    l_new_TD_forecast_df2.loc[:, self.mInitialForecastCol + "_" + iPrefix] = \
-                        l_new_BU_forecast_df.groupby(self.mDateCol)[
-                            self.mInitialForecastCol + "_" + iPrefix].sum().values
-                    results_current_lvl.append(l_new_TD_forecast_df2)
-                oLevelDfDictResultsBU[level] = pd.concat(results_current_lvl)
-
-        return oLevelDfDictResultsBU
-
-    def computeMiddleOutForecasts(self, iProp, iMidLevel, iPrefix='MO'):
-        """
-
-        :param iDateCol: string of column with date
         :param iProp: proportion computed for TD
         :param iMidLevel: number of mid level ( == number levels // 2)
         :param iPrefix: string to add to initial forecast column name
-        :param iInitialForecastCol: string of column name containing initial forecast
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
         :return: dict of DF with midlle out forecasts
         """
-        # Copy initial forecasts (forecast for mid level will be unchanged)
-        oLevelDfDictResultsMO = self.mLevelDfDict.copy()
         # Forecast for mid level is initial forecast (because it is MIDDLE OUT approach)
-        current_df = self.mLevelDfDict[iMidLevel].copy()
-        current_df.loc[:, self.mInitialForecastCol + "_" + iPrefix] = current_df.loc[:, self.mInitialForecastCol]
-        oLevelDfDictResultsMO[iMidLevel] = current_df
-
-        if len(self.mStructure.keys()) > 2:
-            # lower levels .... top-down starting from the middle.
-            levels_below = sorted([level for level in self.mStructure.keys() if (level <= iMidLevel)],
-                                  reverse=True)
-            levels_above = sorted([level for level in self.mStructure.keys() if (level > iMidLevel)],
-                                  reverse=False)
-
-            # lower level : TD approach
-            for level in levels_below:
-                if level > 0:
-                    results_current_lvl = []
-                    for col in self.mStructure[level].keys():
-                        l_new_TD_forecast_df = oLevelDfDictResultsMO[level].groupby(
-                            self.mRevHierarchyOrder[level]).get_group(
-                            col).copy()
-                        # Get the forecast for the +1 level
-                        for col1 in self.mStructure[level][col]:
-                            # Replace the forecast for the current level by forecast lvl+1 * proportion
-                            l_new_TD_forecast_df2 = oLevelDfDictResultsMO[level - 1].groupby(
-                                self.mRevHierarchyOrder[level - 1], as_index=False).get_group(
-                                col1).copy()
-                            l_new_TD_forecast_df2.loc[:,
-                            self.mInitialForecastCol + "_" + iPrefix] = l_new_TD_forecast_df.loc[:,
-                                                                        self.mInitialForecastCol + "_" + iPrefix].values * \
-                                                                        iProp[col][col1]
-                            results_current_lvl.append(l_new_TD_forecast_df2)
-                    oLevelDfDictResultsMO[level - 1] = pd.concat(results_current_lvl)
-
-            # higher levels : BU approach
-            for level in levels_above:
-                if level > 0:
-                    results_current_lvl = []
-                    for col in self.mStructure[level].keys():
-                        l_new_BU_forecast_df = oLevelDfDictResultsMO[level - 1].loc[
-                                               oLevelDfDictResultsMO[level - 1][
-                                                   self.mRevHierarchyOrder[level - 1]].isin(
-                                                   self.mStructure[level][col]), :]
-                        l_new_TD_forecast_df2 = oLevelDfDictResultsMO[level].groupby(
-                            self.mRevHierarchyOrder[level]).get_group(
-                            col).copy()
-                        l_new_TD_forecast_df2.loc[:, self.mInitialForecastCol + "_" + iPrefix] = \
-                            l_new_BU_forecast_df.groupby(self.mDateCol)[
-                                self.mInitialForecastCol + "_" + iPrefix].sum().values
-                        results_current_lvl.append(l_new_TD_forecast_df2)
-                    oLevelDfDictResultsMO[level] = pd.concat(results_current_lvl)
-
-        return oLevelDfDictResultsMO
-
-    def computeOptimalCombination(self, iPrefix='OC'):
+        # lower levels : TD approach, higher levels : BU approach
+        return self.compute_reconciled_level_dfs('computeMiddleOutForecasts', 'MO', iPrefix, iForecastCols, iProp=iProp,
+                                                 iMidLevel=iMidLevel)
+
+    def get_ols_solver(self, iSolver='sparse'):
+        """
+
+        :param iSolver: 'sparse' or 'dense' (see cOlsReconciliationSolver)
+        :return: OLS solver for the summing matrix, its factorisation is kept for next calls
         """
+        if iSolver not in self.mOlsSolvers:
+            self.mOlsSolvers[iSolver] = cOlsReconciliationSolver(self.mSummingMatrix, iSolver)
+        return self.mOlsSolvers[iSolver]
 
+    def computeOptimalCombination(self, iPrefix='OC', iSolver='sparse', iForecastCols=None):
+        """
+
+        :param iPrefix: prefix string to add to forecast col
+        :param iSolver: 'sparse' (default, factorisation of the aggregated nodes system) or 'dense' (explicit
+        inv(S'S), only for small hierarchies)
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
         :return: dict of results dfs for the optimal approach
         """
-        oLevelDfDictResultsOC = self.mLevelDfDict.copy()
-
-        # unpacking all datasets to create multiplication matrix
-        i = 0
-        for level in self.mStructure.keys():
-            for col in self.mStructure[level].keys():
-                l_current_forecast_df = oLevelDfDictResultsOC[level].groupby(self.mRevHierarchyOrder[level]).get_group(
-                    col).copy()
-                l_current_row = l_current_forecast_df.loc[:, self.mInitialForecastCol].values.reshape(1, -1)
-                if i == 0:
-                    M = l_current_row
-                else:
-                    M = np.vstack((M, l_current_row))
-                i += 1
-
-        # Create Summing matrix and computes its pseudo inv to get optimal forecasts
-        S = self.create_summing_matrix()
-        # Pseudo inverse of matrix
-        lPInv = np.linalg.inv(S.T.dot(S)).dot(S.T)
-
-        lOptimalForecasts = S.dot(lPInv.dot(M))
-
-        # Repack optimal forecasts in DF dict of results
-        i = 0
-        for level in self.mStructure.keys():
-            results_current_lvl = []
-            for col in self.mStructure[level].keys():
-                l_current_forecast_df = oLevelDfDictResultsOC[level].groupby(self.mRevHierarchyOrder[level]).get_group(
-                    col).copy()
-                l_current_forecast_df.loc[:, self.mInitialForecastCol + "_" + iPrefix] = lOptimalForecasts[i, :]
-                results_current_lvl.append(l_current_forecast_df)
-                i += 1
-            oLevelDfDictResultsOC[level] = pd.concat(results_current_lvl)
-
-        return oLevelDfDictResultsOC
+        with self.profile('computeOptimalCombination', 'factorize'):
+            lSolver = self.get_ols_solver(iSolver)
+            lSolver.factorize()
+
+        return self.compute_reconciled_level_dfs('computeOptimalCombination', 'OC', iPrefix, iForecastCols,
+                                                 iSolver=lSolver)
+
+    def get_weighted_solver(self, iWeighting='wls_struct', iResiduals=None, iSolver='sparse'):
+        """
+
+        :param iWeighting: 'wls_struct' (structural scaling), 'wls_var' (variance scaling) or 'mint_shrink'
+        (shrinkage covariance, diagonal + low rank)
+        :param iResiduals: array (nodes x dates) of in-sample residuals for 'wls_var' and 'mint_shrink' (e.g.
+        create_forecast_matrix(residuals col, in-sample DFs))
+        :param iSolver: 'sparse' or 'dense' (see cWeightedReconciliationSolver)
+        :return: weighted solver : the last one of each weighting is kept and reused while the residuals window
+        is the same
+        """
+        lKey = (iSolver,)
+        if iWeighting != 'wls_struct':
+            lResiduals = np.ascontiguousarray(iResiduals, dtype=np.float64)
+            lKey = (iSolver, lResiduals.shape, hashlib.sha1(lResiduals).hexdigest())
+        if iWeighting in self.mWeightedSolvers and self.mWeightedSolvers[iWeighting][0] == lKey:
+            return self.mWeightedSolvers[iWeighting][1]
+
+        if iWeighting == 'wls_struct':
+            lWeights, lLowRankFactor = create_structural_weights(self.mSummingMatrix), None
+        elif iWeighting == 'wls_var':
+            lWeights, lLowRankFactor = create_variance_weights(lResiduals), None
+        elif iWeighting == 'mint_shrink':
+            lWeights, lLowRankFactor, lLambda = create_shrinkage_covariance(lResiduals)
+        else:
+            raise ValueError('Unknown weighting : ' + str(iWeighting))
+
+        oSolver = cWeightedReconciliationSolver(self.mSummingMatrix, lWeights, lLowRankFactor, iSolver)
+        self.mWeightedSolvers[iWeighting] = (lKey, oSolver)
+        return oSolver
+
+    def computeWeightedOptimalCombination(self, iWeighting='wls_struct', iResiduals=None, iPrefix='WLS',
+                                          iSolver='sparse', iForecastCols=None):
+        """
+
+        :param iWeighting: 'wls_struct', 'wls_var' or 'mint_shrink' (see get_weighted_solver)
+        :param iResiduals: array (nodes x dates) of in-sample residuals for 'wls_var' and 'mint_shrink'
+        :param iPrefix: prefix string to add to forecast col
+        :param iSolver: 'sparse' or 'dense'
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
+        :return: dict of results dfs for the weighted optimal approach
+        """
+        with self.profile('computeWeightedOptimalCombination', 'factorize'):
+            lSolver = self.get_weighted_solver(iWeighting, iResiduals, iSolver)
+            lSolver.factorize()
+
+        return self.compute_reconciled_level_dfs('computeWeightedOptimalCombination', 'OC', iPrefix, iForecastCols,
+                                                 iSolver=lSolver)
+
+    def create_projection_matrix(self, iMethod, iProp=None, iMidLevel=None, iSolver='sparse'):
+        """
+
+        :param iMethod: 'BU', 'TD', 'MO' or 'OC' ('TDFP' is not linear in forecasts)
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :return: matrix P (nodes x nodes) such that reconciled forecasts are P.y : sparse for BU, TD and MO (same
+        allocation and aggregation steps as reconcile_forecast_matrix, applied to the rows of P), dense for OC
+        (nodes x nodes floats, only for hierarchies of moderate size : incremental and streaming modes use the
+        factorized solver for OC)
+        """
+        if iMethod == 'OC':
+            lSolver = iSolver if hasattr(iSolver, 'reconcile') else self.get_ols_solver(iSolver)
+            return lSolver.reconcile(np.identity(len(self.mNodeIndex)))
+
+        if iMethod == 'BU':
+            lFromLevel = 0
+        elif iMethod == 'TD':
+            lFromLevel = max(self.mLevelSlices.keys())
+        elif iMethod == 'MO':
+            lFromLevel = iMidLevel
+        else:
+            raise ValueError('No projection matrix for reconciliation method : ' + str(iMethod))
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+
+        # Rows of base nodes : allocation of lFromLevel nodes, then all levels are summed from base nodes
+        lStructure = self.get_compact_structure()
+        lIdentity = sps.identity(len(self.mNodeIndex), format='csr')
+        lBlock = lIdentity[self.mLevelSlices[lFromLevel]]
+        for level in self.get_allocation_levels(lFromLevel):
+            lParentLevel = lStructure.mParentLevels[level]
+            lChildren = self.mLevelSlices[level]
+            lParents = self.mParentIndex[lChildren] - self.mLevelSlices[lParentLevel].start
+            lBlock = sps.diags(iProp[lChildren]).dot(lBlock[lParents])
+        lBlocks = {0: lBlock}
+        for level in sorted(lStructure.mChildLevels.keys()):
+            lBlocks[level] = self.mLevelAggregationMatrices[level].dot(lBlocks[lStructure.mChildLevels[level]])
+        return sps.vstack([lBlocks[level] for level in sorted(lBlocks.keys())], format='csr')
+
+    def get_projection_matrix(self, iMethod, iProp=None, iMidLevel=None):
+        """
+
+        :param iMethod: 'BU', 'TD' or 'MO'
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :return: sparse projection matrix (see create_projection_matrix) : the last one of each method is kept and
+        reused while its parameters are the same
+        """
+        lKey = (iMidLevel,)
+        if iMethod in ['TD', 'MO']:
+            if isinstance(iProp, dict):
+                iProp = self.create_proportion_vector(iProp)
+            lKey += (hashlib.sha1(np.ascontiguousarray(iProp, dtype=np.float64)).hexdigest(),)
+        if iMethod in self.mProjections and self.mProjections[iMethod][0] == lKey:
+            return self.mProjections[iMethod][1]
+
+        oProjection = self.create_projection_matrix(iMethod, iProp, iMidLevel)
+        self.mProjections[iMethod] = (lKey, oProjection)
+        return oProjection
+
+    def computeIncrementalForecasts(self, iLevelDfDict, iMethod, iPrefix, iProp=None, iMidLevel=None,
+                                    iSolver='sparse', iForecastCols=None):
+        """
+
+        Incremental mode : reconciles new dates only (e.g. the forecasts of the day) with the projection matrix (BU,
+        TD and MO) or the factorized solver (OC) kept from previous calls (see reconcile_forecast_block). Structure,
+        summing matrix and node index maps are not rebuilt.
+        :param iLevelDfDict: dict of DFs (1 per level) with the forecasts of new dates
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iPrefix: prefix string to add to forecast col
+        :param iProp: proportions for TD and MO (e.g. given by updateTopDownHistoricalProportions)
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
+        :return: copy of iLevelDfDict with reconciled forecasts cols
+        """
+        with self.profile('computeIncrementalForecasts', 'create_forecast_matrix') as lStage:
+            lForecastCells = self.create_forecast_cells(iLevelDfDict)
+            lForecasts = self.create_forecast_matrix(iForecastCols, iLevelDfDict, lForecastCells)
+            lStage.add_counts(nodes=lForecasts.shape[0], dates=lForecasts.shape[1])
+        with self.profile('computeIncrementalForecasts', 'reconcile'):
+            lForecasts = self.reconcile_forecast_block(lForecasts, iMethod, iProp, iMidLevel, iSolver)
+        with self.profile('computeIncrementalForecasts', 'create_level_df_dict'):
+            oLevelDfDict = self.create_level_df_dict(lForecasts, self.get_result_cols(iForecastCols, iPrefix),
+                                                     iLevelDfDict, lForecastCells[1])
+        return oLevelDfDict
+
+    def updateTopDownHistoricalProportions(self, iLevelDfDict, iTsCol):
+        """
+
+        Incremental mode : adds the history of new dates to the running sums of previous calls
+        :param iLevelDfDict: dict of DFs (1 per level) with the history of new dates only
+        :param iTsCol: string of the column to be used to compute proportions
+        :return: average of historical proportions, proportion of historical average over all dates added so far
+        """
+        with self.profile('updateTopDownHistoricalProportions', 'create_forecast_matrix') as lStage:
+            lNodeValues = self.create_forecast_matrix(iTsCol, iLevelDfDict)
+            lStage.add_counts(nodes=lNodeValues.shape[0], dates=lNodeValues.shape[1])
+        with self.profile('updateTopDownHistoricalProportions', 'accumulate_proportion_sums'):
+            self.mProportionSums = self.accumulate_proportion_sums(lNodeValues, self.mProportionSums)
+        with self.profile('updateTopDownHistoricalProportions', 'create_historical_proportions'):
+            return self.create_historical_proportions(self.mProportionSums)
+
+    def reconcile_forecast_block(self, iForecasts, iMethod, iProp=None, iMidLevel=None, iSolver='sparse'):
+        """
+
+        :param iForecasts: array (nodes x ...) of forecasts
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :return: reconciled forecasts : product by the projection matrix for BU, TD and MO, factorized solver for OC
+        (no nodes x nodes matrix), reconcile_forecast_matrix for TDFP
+        """
+        if iMethod in ['BU', 'TD', 'MO']:
+            lShape = iForecasts.shape
+            lProjection = self.get_projection_matrix(iMethod, iProp, iMidLevel)
+            return lProjection.dot(iForecasts.reshape(lShape[0], -1)).reshape(lShape)
+        return self.reconcile_forecast_matrix(iForecasts, iMethod, iProp, iMidLevel, iSolver)
+
+    def reconcileForecastChunks(self, iChunks, iMethod, iPrefix, iProp=None, iMidLevel=None, iSolver='sparse',
+                                iForecastCols=None):
+        """
+
+        Streaming reconciliation : chunks are reconciled one at a time, memory is bounded by the size of a chunk
+        :param iChunks: iterable of dicts of DFs (1 per level), each chunk holds all levels of its dates (e.g. 1 chunk
+        per block of dates)
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iPrefix: prefix string to add to forecast col
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :param iForecastCols: list of forecast columns to reconcile at once (initial forecast column if None)
+        :return: generator of copies of chunks with reconciled forecasts cols
+        """
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+        lResultCols = self.get_result_cols(iForecastCols, iPrefix)
+        for lChunk in iChunks:
+            with self.profile('reconcileForecastChunks', 'create_forecast_matrix') as lStage:
+                lForecastCells = self.create_forecast_cells(lChunk)
+                lForecasts = self.create_forecast_matrix(iForecastCols, lChunk, lForecastCells)
+                lStage.add_counts(nodes=lForecasts.shape[0], dates=lForecasts.shape[1])
+            with self.profile('reconcileForecastChunks', 'reconcile'):
+                lForecasts = self.reconcile_forecast_block(lForecasts, iMethod, iProp, iMidLevel, iSolver)
+            with self.profile('reconcileForecastChunks', 'create_level_df_dict') as lStage:
+                lLevelDfDict = self.create_level_df_dict(lForecasts, lResultCols, lChunk, lForecastCells[1])
+                lStage.add_counts(rows=sum(lLevelDf.shape[0] for lLevelDf in lLevelDfDict.values()))
+            yield lLevelDfDict
+
+    def reconcileForecastArrayChunks(self, iChunks, iMethod, iProp=None, iMidLevel=None, iSolver='sparse'):
+        """
+
+        Streaming reconciliation of arrays (e.g. blocks of dates or blocks of samples read from a Parquet file)
+        :param iChunks: iterable of arrays (nodes x ...), nodes in the order of self.mNodeIndex
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :return: generator of reconciled arrays
+        """
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+        for lChunk in iChunks:
+            with self.profile('reconcileForecastArrayChunks', 'reconcile') as lStage:
+                lForecasts = self.reconcile_forecast_block(np.asarray(lChunk, dtype=np.float64), iMethod, iProp,
+                                                           iMidLevel, iSolver)
+                lStage.add_counts(values=lForecasts.size)
+            yield lForecasts
+
+    def computeReconciledQuantileArray(self, iSamples, iQuantiles=(0.05, 0.5, 0.95), iMethod='OC', iProp=None,
+                                       iMidLevel=None, iSolver='sparse', iNbDatesByBlock=50):
+        """
+
+        Coherent sample paths : all samples of a block of dates are reconciled with a single batched product (see
+        reconcile_forecast_block), then quantiles of reconciled samples are taken for each node and date. Only
+        iNbDatesByBlock dates of reconciled samples are in memory at once.
+        :param iSamples: array (samples x nodes x dates) of sample paths of base forecasts (bootstrap, ensemble
+        members, ...), nodes in the order of self.mNodeIndex
+        :param iQuantiles: list of quantiles (between 0 and 1)
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :param iNbDatesByBlock: number of dates reconciled at once
+        :return: array (quantiles x nodes x dates) of quantiles of reconciled samples
+        """
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+        lNbSamples, lNbNodes, lNbDates = iSamples.shape
+        oQuantiles = np.zeros((len(iQuantiles), lNbNodes, lNbDates))
+        for lStart in range(0, lNbDates, iNbDatesByBlock):
+            lBlock = slice(lStart, min(lStart + iNbDatesByBlock, lNbDates))
+            with self.profile('computeReconciledQuantileArray', 'reconcile') as lStage:
+                # nodes x dates x samples
+                lForecasts = np.asarray(iSamples[:, :, lBlock], dtype=np.float64).transpose(1, 2, 0)
+                lForecasts = self.reconcile_forecast_block(lForecasts, iMethod, iProp, iMidLevel, iSolver)
+                lStage.add_counts(nodes=lNbNodes, dates=lForecasts.shape[1], samples=lNbSamples)
+            with self.profile('computeReconciledQuantileArray', 'percentile'):
+                oQuantiles[:, :, lBlock] = np.percentile(lForecasts, 100. * np.asarray(iQuantiles), axis=2)
+        return oQuantiles
+
+    def computeReconciledQuantiles(self, iSampleCols, iQuantiles=(0.05, 0.5, 0.95), iMethod='OC', iPrefix='OC',
+                                   iProp=None, iMidLevel=None, iSolver='sparse', iNbDatesByBlock=50):
+        """
+
+        Prediction intervals from coherent sample paths (see computeReconciledQuantileArray)
+        :param iSampleCols: list of columns of level DFs with sample paths of base forecasts (e.g. the prediction of
+        each tree of a random forest, see htsForecaster.predict_estimators)
+        :param iQuantiles: list of quantiles (between 0 and 1)
+        :param iMethod: 'BU', 'TD', 'TDFP', 'MO' or 'OC'
+        :param iPrefix: prefix string to add to forecast col
+        :param iProp: proportions for TD and MO
+        :param iMidLevel: mid level for MO
+        :param iSolver: solver for OC
+        :param iNbDatesByBlock: number of dates reconciled at once
+        :return: copy of self.mLevelDfDict with a column initial forecast col + '_' + iPrefix + '_q' + quantile for
+        each quantile
+        """
+        if isinstance(iProp, dict):
+            iProp = self.create_proportion_vector(iProp)
+        lNbDates = len(self.mDates)
+        lQuantiles = np.zeros((len(self.mNodeIndex), lNbDates, len(iQuantiles)))
+        for lStart in range(0, lNbDates, iNbDatesByBlock):
+            lStop = min(lStart + iNbDatesByBlock, lNbDates)
+            with self.profile('computeReconciledQuantiles', 'create_sample_array') as lStage:
+                # Only rows of the block of dates are unpacked
+                lSamples = np.zeros((len(iSampleCols), len(self.mNodeIndex), lStop - lStart))
+                for level, (lRows, lCols) in self.mLevelCells.items():
+                    lInBlock = np.flatnonzero((lCols >= lStart) & (lCols < lStop))
+                    lValues = self.mLevelDfDict[level].iloc[lInBlock].loc[:, iSampleCols].values
+                    lSamples[:, lRows[lInBlock], lCols[lInBlock] - lStart] = lValues.T
+                lStage.add_counts(nodes=lSamples.shape[1], dates=lSamples.shape[2], samples=lSamples.shape[0])
+            # Reconciliation and percentiles are profiled by computeReconciledQuantileArray
+            lQuantiles[:, lStart:lStop] = self.computeReconciledQuantileArray(
+                lSamples, iQuantiles, iMethod, iProp, iMidLevel, iSolver, iNbDatesByBlock).transpose(1, 2, 0)
+
+        with self.profile('computeReconciledQuantiles', 'create_level_df_dict') as lStage:
+            oLevelDfDict = self.create_level_df_dict(lQuantiles, [self.mInitialForecastCol + '_' + iPrefix + '_q' +
+                                                                  str(q) for q in iQuantiles])
+            lStage.add_counts(rows=sum(lLevelDf.shape[0] for lLevelDf in oLevelDfDict.values()))
+        return oLevelDfDict
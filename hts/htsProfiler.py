@@ -0,0 +1,172 @@
+# Opt-in instrumentation : wall time, memory peak and counts of each stage of hierarchy and reconciliation methods
+
+import os
+import threading
+import time
+
+import pandas as pd
+
+
+def get_resident_size():
+    """
+
+    :return: resident size of the process in bytes (None if /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as lStatm:
+            return int(lStatm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return None
+
+
+class cResidentSizeSampler(threading.Thread):
+    def __init__(self, iPeriod=0.001):
+        """
+
+        Samples the resident size of the process until stop() is called
+        :param iPeriod: sampling period in seconds
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mPeriod = iPeriod
+        self.mStart = get_resident_size()
+        self.mPeak = self.mStart
+        self.mStopEvent = threading.Event()
+
+    def run(self):
+        while self.mStart is not None and not self.mStopEvent.is_set():
+            self.mPeak = max(self.mPeak, get_resident_size())
+            self.mStopEvent.wait(self.mPeriod)
+
+    def stop(self):
+        """
+
+        :return: peak increase of the resident size in bytes (None if not available)
+        """
+        self.mStopEvent.set()
+        self.join()
+        if self.mStart is None:
+            return None
+        return max(self.mPeak, get_resident_size()) - self.mStart
+
+
+class cStageRecord(object):
+    def __init__(self, iMethod, iStage):
+        """
+
+        Measures of a stage of a method, filled by cHtsProfiler.stage
+        :param iMethod: name of the method (e.g. 'computeOptimalCombination')
+        :param iStage: name of the stage (e.g. 'create_forecast_matrix', 'reconcile', 'create_level_df_dict')
+        """
+        self.mMethod = iMethod
+        self.mStage = iStage
+        self.mSeconds = None
+        self.mPeakBytes = None
+        self.mCounts = {}
+
+    def add_counts(self, **kwargs):
+        """
+
+        :param kwargs: counts of the stage (nodes, rows, nnz, ...)
+        """
+        self.mCounts.update(kwargs)
+
+    def to_dict(self):
+        """
+
+        :return: dict with method, stage, seconds, peak_mb and counts
+        """
+        oDict = dict(self.mCounts)
+        oDict.update({'method': self.mMethod, 'stage': self.mStage, 'seconds': self.mSeconds,
+                      'peak_mb': self.mPeakBytes / 1024. ** 2 if self.mPeakBytes is not None else None})
+        return oDict
+
+
+class cNoStage(object):
+    """
+
+    Stage used when profiling is disabled : a shared context doing nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, iType, iValue, iTraceback):
+        return False
+
+    def add_counts(self, **kwargs):
+        pass
+
+
+gNoStage = cNoStage()
+
+
+class cProfiledStage(object):
+    def __init__(self, iProfiler, iRecord):
+        self.mProfiler = iProfiler
+        self.mRecord = iRecord
+        self.mSampler = None
+        self.mStart = None
+
+    def __enter__(self):
+        if self.mProfiler.mTrackMemory:
+            self.mSampler = cResidentSizeSampler(self.mProfiler.mSamplingPeriod)
+            self.mSampler.start()
+        self.mStart = time.time()
+        return self.mRecord
+
+    def __exit__(self, iType, iValue, iTraceback):
+        self.mRecord.mSeconds = time.time() - self.mStart
+        if self.mSampler is not None:
+            self.mRecord.mPeakBytes = self.mSampler.stop()
+        if iType is None:
+            self.mProfiler.add_record(self.mRecord)
+        return False
+
+
+class cHtsProfiler(object):
+    def __init__(self, iTrackMemory=True, iCallbacks=None, iSamplingPeriod=0.001):
+        """
+
+        Collects a cStageRecord for each stage of the methods of cHierarchyHandler / cHtsOptimizer it is given to
+        (iProfiler argument). Without profiler, stages are a shared context doing nothing.
+        :param iTrackMemory: if True, peak increase of the resident size of each stage is sampled by a thread
+        :param iCallbacks: list of functions(cStageRecord) called at the end of each stage (e.g. logging)
+        :param iSamplingPeriod: memory sampling period in seconds
+        """
+        self.mTrackMemory = iTrackMemory
+        self.mCallbacks = list(iCallbacks) if iCallbacks is not None else []
+        self.mSamplingPeriod = iSamplingPeriod
+        self.mRecords = []
+
+    def add_callback(self, iCallback):
+        """
+
+        :param iCallback: function(cStageRecord) called at the end of each stage
+        """
+        self.mCallbacks.append(iCallback)
+
+    def stage(self, iMethod, iStage):
+        """
+
+        :return: context measuring a stage, yields its cStageRecord (to add counts)
+        """
+        return cProfiledStage(self, cStageRecord(iMethod, iStage))
+
+    def add_record(self, iRecord):
+        self.mRecords.append(iRecord)
+        for lCallback in self.mCallbacks:
+            lCallback(iRecord)
+
+    def get_report(self):
+        """
+
+        :return: DF with 1 row per stage (method, stage, seconds, peak_mb and counts columns)
+        """
+        lColumns = ['method', 'stage', 'seconds', 'peak_mb']
+        oReport = pd.DataFrame([lRecord.to_dict() for lRecord in self.mRecords])
+        if oReport.shape[0] == 0:
+            return pd.DataFrame(columns=lColumns)
+        return oReport.loc[:, lColumns + sorted(set(oReport.columns) - set(lColumns))]
+
+    def reset(self):
+        self.mRecords = []
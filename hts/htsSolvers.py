@@ -0,0 +1,217 @@
+# Reconciliation solvers : compute S.inv(S'S).S'.y without building inv(S'S)
+
+import numpy as np
+import scipy.sparse as sps
+import scipy.sparse.linalg as spsl
+
+
+class cOlsReconciliationSolver:
+    def __init__(self, iSummingMatrix, iMethod='sparse'):
+        """
+
+        Rows of the summing matrix must start with the base level (identity block) and end with aggregated nodes,
+        as returned by cHierarchyHandler.create_sparse_summing_matrix : S = [I ; C]
+        With Woodbury identity, inv(S'S) = inv(I + C'C) = I - C'.inv(I + CC').C
+        I + CC' is (nb aggregated nodes x nb aggregated nodes) and is sparse : CC'[a, b] != 0 only if a is an
+        ancestor of b (or b of a). Its sparse LU factorisation is computed once and reused for all dates and calls.
+
+        :param iSummingMatrix: summing matrix (scipy sparse or numpy array)
+        :param iMethod: 'sparse' (factorisation of I + CC') or 'dense' (explicit inv(S'S), reference path)
+        """
+        self.mSummingMatrix = sps.csr_matrix(iSummingMatrix)
+        self.mMethod = iMethod
+        self.mBaseLevelCount = self.mSummingMatrix.shape[1]
+        self.mAggregationMatrix = self.mSummingMatrix[self.mBaseLevelCount:, :]
+        self.mFactor = None
+
+    def factorize(self):
+        """
+
+        Computes (once) the factorisation used to solve the normal equations
+        :return: the factorisation (splu object for sparse method, inv(S'S) for dense one)
+        """
+        if self.mFactor is None:
+            if self.mMethod == 'dense':
+                S = self.mSummingMatrix
+                self.mFactor = np.linalg.inv(S.T.dot(S).toarray())
+            elif self.mMethod == 'sparse':
+                C = self.mAggregationMatrix
+                if C.shape[0] > 0:
+                    lK = sps.identity(C.shape[0], format='csc') + C.dot(C.T).tocsc()
+                    self.mFactor = spsl.splu(lK)
+            else:
+                raise ValueError('Unknown reconciliation method : ' + str(self.mMethod))
+        return self.mFactor
+
+    def computeBaseLevelForecasts(self, iForecasts):
+        """
+
+        :param iForecasts: array (nb nodes x ...) of initial forecasts, rows in summing matrix order, all trailing
+        dimensions (dates, columns, samples) are solved at once
+        :return: array (nb base nodes x ...) of reconciled base level forecasts : inv(S'S).S'.y
+        """
+        lFactor = self.factorize()
+        S = self.mSummingMatrix
+        lShape = (self.mBaseLevelCount,) + iForecasts.shape[1:]
+        lStY = S.T.dot(iForecasts.reshape(iForecasts.shape[0], -1))
+
+        if self.mMethod == 'dense':
+            return lFactor.dot(lStY).reshape(lShape)
+
+        if lFactor is None:
+            # Only base level : nothing to reconcile
+            return lStY.reshape(lShape)
+
+        C = self.mAggregationMatrix
+        lCorrection = lFactor.solve(C.dot(lStY))
+        return (lStY - C.T.dot(lCorrection)).reshape(lShape)
+
+    def reconcile(self, iForecasts):
+        """
+
+        :param iForecasts: array (nb nodes x ...) of initial forecasts, rows in summing matrix order
+        :return: array (nb nodes x ...) of reconciled forecasts : S.inv(S'S).S'.y
+        """
+        lBaseForecasts = self.computeBaseLevelForecasts(iForecasts)
+        oForecasts = self.mSummingMatrix.dot(lBaseForecasts.reshape(self.mBaseLevelCount, -1))
+        return oForecasts.reshape((-1,) + lBaseForecasts.shape[1:])
+
+
+class cWeightedReconciliationSolver:
+    def __init__(self, iSummingMatrix, iWeights, iLowRankFactor=None, iMethod='sparse'):
+        """
+
+        Generalized least squares reconciliation (WLS / MinT) with error covariance W = diag(iWeights) + V.V'
+        With S = [I ; C] and U' = [I, -C] : base level forecasts are y_b - J.W.U.inv(U'.W.U).U'.y
+        U'.diag(w).U = diag(w_a) + C.diag(w_b).C' is sparse (same pattern as OLS) : its sparse LU is computed once,
+        the low rank part (V' has as many rows as residual dates) is added with Woodbury identity.
+
+        :param iSummingMatrix: summing matrix (scipy sparse or numpy array), base level rows first
+        :param iWeights: array (nb nodes) of the diagonal part of W
+        :param iLowRankFactor: array (nb nodes x rank) V of the low rank part of W (None for a diagonal W)
+        :param iMethod: 'sparse' or 'dense' (explicit inverse of S'.inv(W).S, reference path)
+        """
+        self.mSummingMatrix = sps.csr_matrix(iSummingMatrix)
+        self.mWeights = np.asarray(iWeights, dtype=np.float64)
+        self.mLowRankFactor = iLowRankFactor
+        self.mMethod = iMethod
+        self.mBaseLevelCount = self.mSummingMatrix.shape[1]
+        self.mAggregationMatrix = self.mSummingMatrix[self.mBaseLevelCount:, :]
+        self.mFactor = None
+
+    def factorize(self):
+        """
+
+        Computes (once) the factorisation used to solve the normal equations
+        :return: the factorisation (splu object, U'V, inv(K0).U'V, capacitance matrix) for sparse method,
+        G = inv(S'.inv(W).S).S'.inv(W) for dense one
+        """
+        if self.mFactor is None:
+            C = self.mAggregationMatrix
+            lNbBase = self.mBaseLevelCount
+            if self.mMethod == 'dense':
+                S = self.mSummingMatrix.toarray()
+                W = np.diag(self.mWeights)
+                if self.mLowRankFactor is not None:
+                    W = W + self.mLowRankFactor.dot(self.mLowRankFactor.T)
+                lStWInv = np.linalg.solve(W, S).T
+                self.mFactor = np.linalg.solve(lStWInv.dot(S), lStWInv)
+            elif self.mMethod == 'sparse':
+                if C.shape[0] > 0:
+                    lK = sps.diags(self.mWeights[lNbBase:]) + C.dot(sps.diags(self.mWeights[:lNbBase])).dot(C.T)
+                    lLU = spsl.splu(sps.csc_matrix(lK))
+                    lUtV = None
+                    lK0InvUtV = None
+                    lCapacitance = None
+                    if self.mLowRankFactor is not None:
+                        lUtV = self.mLowRankFactor[lNbBase:] - C.dot(self.mLowRankFactor[:lNbBase])
+                        lK0InvUtV = lLU.solve(np.asarray(lUtV, dtype=np.float64))
+                        lCapacitance = np.identity(lUtV.shape[1]) + lUtV.T.dot(lK0InvUtV)
+                    self.mFactor = (lLU, lUtV, lK0InvUtV, lCapacitance)
+            else:
+                raise ValueError('Unknown reconciliation method : ' + str(self.mMethod))
+        return self.mFactor
+
+    def computeBaseLevelForecasts(self, iForecasts):
+        """
+
+        :param iForecasts: array (nb nodes x ...) of initial forecasts, rows in summing matrix order
+        :return: array (nb base nodes x ...) of reconciled base level forecasts
+        """
+        lFactor = self.factorize()
+        lNbBase = self.mBaseLevelCount
+        lShape = (lNbBase,) + iForecasts.shape[1:]
+        lForecasts = iForecasts.reshape(iForecasts.shape[0], -1)
+
+        if self.mMethod == 'dense':
+            return lFactor.dot(lForecasts).reshape(lShape)
+
+        if lFactor is None:
+            # Only base level : nothing to reconcile
+            return lForecasts.copy().reshape(lShape)
+
+        lLU, lUtV, lK0InvUtV, lCapacitance = lFactor
+        C = self.mAggregationMatrix
+        lBase = lForecasts[:lNbBase]
+        # K = U'WU, k = inv(K).U'y
+        k = lLU.solve(np.asarray(lForecasts[lNbBase:] - C.dot(lBase), dtype=np.float64))
+        if self.mLowRankFactor is not None:
+            k = k - lK0InvUtV.dot(np.linalg.solve(lCapacitance, lUtV.T.dot(k)))
+        # y_b - J.W.U.k with J.W.U = -diag(w_b).C' + V_b.(U'V)'
+        oBase = lBase + self.mWeights[:lNbBase, np.newaxis] * C.T.dot(k)
+        if self.mLowRankFactor is not None:
+            oBase = oBase - self.mLowRankFactor[:lNbBase].dot(lUtV.T.dot(k))
+        return oBase.reshape(lShape)
+
+    def reconcile(self, iForecasts):
+        """
+
+        :param iForecasts: array (nb nodes x ...) of initial forecasts, rows in summing matrix order
+        :return: array (nb nodes x ...) of reconciled forecasts
+        """
+        lBaseForecasts = self.computeBaseLevelForecasts(iForecasts)
+        oForecasts = self.mSummingMatrix.dot(lBaseForecasts.reshape(self.mBaseLevelCount, -1))
+        return oForecasts.reshape((-1,) + lBaseForecasts.shape[1:])
+
+
+def create_structural_weights(iSummingMatrix):
+    """
+
+    :param iSummingMatrix: summing matrix
+    :return: array of WLS structural scaling weights (number of base nodes under each node)
+    """
+    return np.asarray(iSummingMatrix.sum(axis=1), dtype=np.float64).ravel()
+
+
+def create_variance_weights(iResiduals):
+    """
+
+    :param iResiduals: array (nb nodes x nb dates) of in-sample residuals
+    :return: array of WLS variance scaling weights (mean of squared residuals of each node)
+    """
+    return (iResiduals ** 2).mean(axis=1)
+
+
+def create_shrinkage_covariance(iResiduals):
+    """
+
+    Shrinkage of the residuals covariance towards its diagonal (Schafer and Strimmer, 2005, as in MinT shrink) :
+    W = lambda.diag(Cov) + (1 - lambda).Cov, returned as diagonal + low rank so that nodes x nodes is never built
+    :param iResiduals: array (nb nodes x nb dates) of in-sample residuals
+    :return: diagonal part (nb nodes), low rank factor V (nb nodes x nb dates), lambda (estimated on nodes with
+    non-zero variance)
+    """
+    lNbDates = iResiduals.shape[1]
+    lVariances = create_variance_weights(iResiduals)
+    # Standardized residuals (dates x nodes) : Cor = Xs'.Xs / T and sums over nodes pairs use T x T products
+    # Nodes with zero variance (e.g. all-zero series) have no correlation with other nodes : they are left out
+    lNonZero = lVariances > 0
+    lXs = (iResiduals[lNonZero] / np.sqrt(lVariances[lNonZero])[:, np.newaxis]).T
+    lXs2 = lXs ** 2
+    lGram = lXs.dot(lXs.T)
+    lSumCor2 = (lGram ** 2).sum() / lNbDates ** 2 - lXs.shape[1]
+    lSumVar = ((lXs2.sum(axis=1) ** 2).sum() - (lGram ** 2).sum() / lNbDates -
+               ((lXs2 ** 2).sum() - (lXs2.sum(axis=0) ** 2).sum() / lNbDates)) / (lNbDates * (lNbDates - 1))
+    oLambda = max(min(lSumVar / lSumCor2, 1.), 0.) if lSumCor2 > 0 else 1.
+
+    return oLambda * lVariances, np.sqrt((1. - oLambda) / lNbDates) * iResiduals, oLambda
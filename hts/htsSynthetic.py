@@ -0,0 +1,82 @@
+# Synthetic hierarchies and time series (benchmarks, scaling tests)
+
+import numpy as np
+import pandas as pd
+
+
+def create_synthetic_hierarchy(iNbLeaves, iFanOut=10, iDepth=3):
+    """
+
+    :param iNbLeaves: number of nodes of base level
+    :param iFanOut: number of children of each node (the last node of each level may have less)
+    :param iDepth: number of levels, the highest one is a single 'All' node
+    :return: hierarchy DF (1 row per base node, 1 column per level), hierarchy order
+    """
+    if iDepth < 2:
+        raise ValueError('A hierarchy needs at least 2 levels')
+    lLeaves = np.arange(iNbLeaves)
+    oHierarchy = pd.DataFrame()
+    oHierarchyOrder = {}
+    for level in range(iDepth - 1):
+        lCol = 'Level' + str(level)
+        lNodes = lLeaves // (iFanOut ** level)
+        oHierarchy.loc[:, lCol] = 'L' + str(level) + '_' + pd.Series(lNodes).astype(str)
+        oHierarchyOrder[lCol] = level
+    oHierarchy.loc[:, 'All'] = 'All'
+    oHierarchyOrder['All'] = iDepth - 1
+    return oHierarchy, oHierarchyOrder
+
+
+def create_synthetic_series(iHierarchy, iHierarchyOrder, iNbDates, iTargetCol='Value', iDateCol='Date',
+                            iStartDate='2016-01-01', iFreq='D', iMissingRate=0., iSeed=0):
+    """
+
+    Base level series : random level of each node, weekly seasonality and Poisson noise
+    :param iHierarchy: hierarchy DF (see create_synthetic_hierarchy)
+    :param iHierarchyOrder: hierarchy order
+    :param iNbDates: number of dates
+    :param iTargetCol: value column
+    :param iDateCol: date column
+    :param iStartDate: first date
+    :param iFreq: frequency of dates
+    :param iMissingRate: share of (date, node) rows removed (holes to densify)
+    :param iSeed: random seed
+    :return: DF with date, base level and value columns
+    """
+    lRandom = np.random.RandomState(iSeed)
+    lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lLeaves = iHierarchy.loc[:, lRevHierarchyOrder[0]].values
+    lDates = pd.date_range(iStartDate, periods=iNbDates, freq=iFreq)
+
+    lLevels = lRandom.gamma(2., 5., len(lLeaves))
+    lSeasonality = 1. + 0.3 * np.sin(2. * np.pi * np.arange(iNbDates) / 7.)
+    lValues = lRandom.poisson(lSeasonality[:, np.newaxis] * lLevels[np.newaxis, :]).astype(np.float64)
+
+    oDf = pd.DataFrame({iDateCol: np.repeat(lDates.values, len(lLeaves)),
+                        lRevHierarchyOrder[0]: np.tile(lLeaves, iNbDates),
+                        iTargetCol: lValues.ravel()})
+    if iMissingRate > 0:
+        oDf = oDf.loc[lRandom.uniform(size=oDf.shape[0]) >= iMissingRate, :].reset_index(drop=True)
+    return oDf
+
+
+def create_synthetic_forecasts(iLevelDfDict, iTargetCol='Value', iForecastCol='Forecast', iNoise=0.1, iSeed=0):
+    """
+
+    Incoherent base forecasts : values of each level with a noise proportional to values + 1
+    :param iLevelDfDict: dict of DFs (1 per level) with iTargetCol
+    :param iTargetCol: value column
+    :param iForecastCol: forecast column to add
+    :param iNoise: standard deviation of the noise
+    :param iSeed: random seed
+    :return: copy of iLevelDfDict with iForecastCol
+    """
+    lRandom = np.random.RandomState(iSeed)
+    oLevelDfDict = {}
+    for level in sorted(iLevelDfDict.keys()):
+        lLevelDf = iLevelDfDict[level].copy()
+        lValues = lLevelDf.loc[:, iTargetCol].values
+        lLevelDf.loc[:, iForecastCol] = lValues + iNoise * (np.abs(lValues) + 1.) * lRandom.standard_normal(
+            lLevelDf.shape[0])
+        oLevelDfDict[level] = lLevelDf
+    return oLevelDfDict
@@ -1,7 +1,14 @@
 # Simple script with useful functions to manipulate DFs
 
+import hashlib
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
 
+from hierarchyHandler import cHierarchyHandler, get_label_codes
+
 
 def cross_join_2_dfs(iDf1, iDf2, **kwargs):
     """
@@ -11,12 +18,8 @@ def cross_join_2_dfs(iDf1, iDf2, **kwargs):
     :param kwargs:
     :return: cross joined DF
     """
-    iDf1['_tmpkey'] = 1
-    iDf2['_tmpkey'] = 1
-    oRes = pd.merge(iDf1, iDf2, on='_tmpkey', **kwargs).drop('_tmpkey', axis=1)
-
-    iDf1.drop('_tmpkey', axis=1, inplace=True)
-    iDf2.drop('_tmpkey', axis=1, inplace=True)
+    # assign returns copies : input DFs are not modified
+    oRes = pd.merge(iDf1.assign(_tmpkey=1), iDf2.assign(_tmpkey=1), on='_tmpkey', **kwargs).drop('_tmpkey', axis=1)
 
     return oRes
 
@@ -61,23 +64,154 @@ def split_tr_test(iDf, iDateCol, iDateThreshold):
     return oTrDf, oTsDf
 
 
-def create_df_dict_for_each_level(iDf, iDateCol, iTargetCols, iHierarchyOrder):
+def create_df_dict_for_each_level(iDf, iDateCol, iTargetCols, iHierarchyOrder, iFromLevelBelow=False):
     """
 
     :param iDf: input DF
     :param iDateCol: date column
     :param iTargetCol: target col to aggregate
     :param iHierarchyOrder: hierarchy
+    :param iFromLevelBelow: if True, iDf is grouped once at level 0 and each level is summed from the level below
+    (strict hierarchies only : each level must be a refinement of the next one)
     :return: dict of df with 1 DF per level of the hierarchy
     """
     lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
     oLevelDf = {}
-    for level in lRevHierarchyOrder.keys():
-        oLevelDf[level] = iDf.groupby([iDateCol, lRevHierarchyOrder[level]], as_index=False)[iTargetCols].sum()
+    if not iFromLevelBelow:
+        for level in lRevHierarchyOrder.keys():
+            # observed=True : categorical level columns (see create_full_df_from_dense_matrix) only give their
+            # (date, node) pairs of iDf, not the product of all categories
+            oLevelDf[level] = iDf.groupby([iDateCol, lRevHierarchyOrder[level]], as_index=False,
+                                          observed=True)[iTargetCols].sum()
+        return oLevelDf
+
+    # Level columns of upper levels are kept as keys to sum next level from the current one
+    lLevels = sorted(lRevHierarchyOrder.keys())
+    lCurrentDf = iDf
+    for level in lLevels:
+        lKeys = [iDateCol] + [lRevHierarchyOrder[upper_level] for upper_level in lLevels if upper_level >= level]
+        lCurrentDf = lCurrentDf.groupby(lKeys, as_index=False, observed=True)[iTargetCols].sum()
+        oLevelDf[level] = lCurrentDf.loc[:, [iDateCol, lRevHierarchyOrder[level]] + list(iTargetCols)]
 
     return oLevelDf
 
 
+def create_node_date_matrix(iDf, iDateCol, iTargetCols, iHierarchyOrder, iSummingMatrix, iNodeIndex):
+    """
+
+    Sums level 0 values at all levels with a single sparse product S x Y_base
+    :param iDf: input DF with level 0 column
+    :param iDateCol: date column
+    :param iTargetCols: target cols to aggregate
+    :param iHierarchyOrder: hierarchy
+    :param iSummingMatrix: sparse summing matrix (see cHierarchyHandler.create_sparse_summing_matrix)
+    :param iNodeIndex: node index of the summing matrix rows
+    :return: dates, array (nodes x dates x iTargetCols), rows in the order of iNodeIndex
+    """
+    lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lLevel0Uniq = pd.Index(iNodeIndex.get_level_values(1)[:iSummingMatrix.shape[1]])
+    lDateCodes, lDates = pd.factorize(iDf.loc[:, iDateCol], sort=True)
+
+    lBaseMatrix = fill_dense_matrix(np.zeros((len(lLevel0Uniq), len(lDates), len(iTargetCols))),
+                                    get_label_codes(lLevel0Uniq, iDf.loc[:, lRevHierarchyOrder[0]]), lDateCodes,
+                                    iDf.loc[:, iTargetCols].values)
+    oMatrix = iSummingMatrix.dot(lBaseMatrix.reshape(len(lLevel0Uniq), -1))
+
+    return lDates, oMatrix.reshape(iSummingMatrix.shape[0], len(lDates), len(iTargetCols))
+
+
+def create_date_range(iDf, iDateCol, iFreq, iFromDateCol=True, iDateRange=None):
+    """
+
+    :param iDf: input DF
+    :param iDateCol: if iFromDateCol is True, get date range from iDateCol
+    :param iFreq: frequency of dates (Days, Weeks, etc)
+    :param iFromDateCol: boolean True or False : if False, get date range from iDateRange
+    :param iDateRange: if iFromDateCol is False, use this date range
+    :return: DatetimeIndex of all dates
+    """
+    if iFromDateCol:
+        return pd.date_range(start=iDf.loc[:, iDateCol].min(), end=iDf.loc[:, iDateCol].max(), freq=iFreq)
+    return pd.date_range(start=pd.to_datetime(iDateRange[0]), end=pd.to_datetime(iDateRange[1]), freq=iFreq)
+
+
+def fill_dense_matrix(ioMatrix, iRowCodes, iColCodes, iValues):
+    """
+
+    Adds values to a preallocated matrix, values of duplicated (row, col) are summed, rows with a -1 code are ignored
+    :param ioMatrix: array (rows x cols x values) to fill
+    :param iRowCodes: array of row of each value
+    :param iColCodes: array of col of each value
+    :param iValues: array (nb values x nb value cols)
+    :return: ioMatrix
+    """
+    lKept = (iRowCodes >= 0) & (iColCodes >= 0)
+    lKeys = iRowCodes[lKept].astype(np.int64) * ioMatrix.shape[1] + iColCodes[lKept]
+    lOrder = np.argsort(lKeys, kind='mergesort')
+    lUniqueKeys, lStarts = np.unique(lKeys[lOrder], return_index=True)
+    if len(lUniqueKeys) > 0:
+        ioMatrix.reshape(-1, ioMatrix.shape[2])[lUniqueKeys] += np.add.reduceat(
+            np.asarray(iValues, dtype=np.float64)[lKept][lOrder], lStarts, axis=0)
+    return ioMatrix
+
+
+def create_dense_leaf_matrix(iDf, iHierarchy, iHierarchyOrder, iTargetCols, iDateCol, iFreq, iFromDateCol=True,
+                             iDateRange=None):
+    """
+
+    :param iDf: input DF
+    :param iHierarchy: hierarchy
+    :param iHierarchyOrder: hierarchy order
+    :param iTargetCols: iTargetCols to keep
+    :param iDateCol: date column
+    :param iFreq: frequency of dates (Days, Weeks, etc)
+    :param iFromDateCol: boolean True or False : if False, get date range from iDateRange
+    :param iDateRange: if iFromDateCol is False, use this date range
+    :return: dates, level 0 nodes, array (dates x level 0 nodes x iTargetCols) of summed values (0 where no data)
+    """
+    lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lDateRange = create_date_range(iDf, iDateCol, iFreq, iFromDateCol, iDateRange)
+    lLevel0Uniq = pd.Index(iHierarchy.loc[:, lRevHierarchyOrder[0]].unique())
+
+    oMatrix = np.zeros((len(lDateRange), len(lLevel0Uniq), len(iTargetCols)))
+    fill_dense_matrix(oMatrix, lDateRange.get_indexer(iDf.loc[:, iDateCol]),
+                      get_label_codes(lLevel0Uniq, iDf.loc[:, lRevHierarchyOrder[0]]), iDf.loc[:, iTargetCols].values)
+
+    return lDateRange, lLevel0Uniq, oMatrix
+
+
+def create_full_df_from_dense_matrix(iDates, iLevel0Uniq, iMatrix, iHierarchy, iHierarchyOrder, iTargetCols,
+                                     iDateCol):
+    """
+
+    :param iDates: dates of iMatrix
+    :param iLevel0Uniq: level 0 nodes of iMatrix
+    :param iMatrix: array (dates x level 0 nodes x iTargetCols)
+    :param iHierarchy: hierarchy
+    :param iHierarchyOrder: hierarchy order
+    :param iTargetCols: target cols
+    :param iDateCol: date column
+    :return: full df with all dates x level 0 + all upper levels, level columns are categorical
+    """
+    lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lNbDates, lNbLeaves = len(iDates), len(iLevel0Uniq)
+    lLeafHierarchy = iHierarchy.drop_duplicates(lRevHierarchyOrder[0]).set_index(lRevHierarchyOrder[0]) \
+        .reindex(iLevel0Uniq)
+
+    oFullDf = pd.DataFrame({iDateCol: np.repeat(np.asarray(iDates), lNbLeaves)})
+    oFullDf.loc[:, lRevHierarchyOrder[0]] = pd.Categorical.from_codes(np.tile(np.arange(lNbLeaves), lNbDates),
+                                                                      iLevel0Uniq)
+    for col in iHierarchy.columns:
+        if col != lRevHierarchyOrder[0]:
+            lCodes, lUniques = pd.factorize(lLeafHierarchy.loc[:, col].values)
+            oFullDf.loc[:, col] = pd.Categorical.from_codes(np.tile(lCodes, lNbDates), lUniques)
+    lValues = iMatrix.reshape(lNbDates * lNbLeaves, -1)
+    for k, col in enumerate(iTargetCols):
+        oFullDf.loc[:, col] = lValues[:, k]
+
+    return oFullDf
+
+
 def create_full_df_with_hierarchy(iDf, iHierarchy, iHierarchyOrder, iTargetCols, iDateCol, iFreq, iFromDateCol=True,
                                   iDateRange=None):
     """
@@ -92,24 +226,263 @@ def create_full_df_with_hierarchy(iDf, iHierarchy, iHierarchyOrder, iTargetCols,
     :param iDateRange: if iFromDateCol is False, use this date range
     :return: full df with all cross join between dates and level 0 + all upper levels
     """
+    lDates, lLevel0Uniq, lMatrix = create_dense_leaf_matrix(iDf, iHierarchy, iHierarchyOrder, iTargetCols, iDateCol,
+                                                            iFreq, iFromDateCol, iDateRange)
+
+    return create_full_df_from_dense_matrix(lDates, lLevel0Uniq, lMatrix, iHierarchy, iHierarchyOrder, iTargetCols,
+                                            iDateCol)
+
+
+def create_full_df_chunks(iDf, iHierarchy, iHierarchyOrder, iTargetCols, iDateCol, iFreq, iFromDateCol=True,
+                          iDateRange=None, iNbDatesByChunk=30):
+    """
+
+    Chunked version of create_full_df_with_hierarchy : only iNbDatesByChunk dates are densified at once
+    :param iNbDatesByChunk: number of dates of each chunk
+    (other params : see create_full_df_with_hierarchy)
+    :return: generator of full dfs, one for each block of dates
+    """
     lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lDateRange = create_date_range(iDf, iDateCol, iFreq, iFromDateCol, iDateRange)
+    lLevel0Uniq = pd.Index(iHierarchy.loc[:, lRevHierarchyOrder[0]].unique())
 
-    if iFromDateCol:
-        lDateRange = pd.date_range(start=iDf.loc[:, iDateCol].min(), end=iDf.loc[:, iDateCol].max(), freq=iFreq)
+    # Rows sorted by date code : rows of each block are a contiguous slice
+    lDateCodes = lDateRange.get_indexer(iDf.loc[:, iDateCol])
+    lOrder = np.argsort(lDateCodes, kind='mergesort')
+    lDateCodes = lDateCodes[lOrder]
+    lLeafCodes = get_label_codes(lLevel0Uniq, iDf.loc[:, lRevHierarchyOrder[0]])[lOrder]
+    lValues = iDf.loc[:, iTargetCols].values[lOrder]
+
+    for lStart in range(0, len(lDateRange), iNbDatesByChunk):
+        lDates = lDateRange[lStart:lStart + iNbDatesByChunk]
+        lFirst, lLast = np.searchsorted(lDateCodes, [lStart, lStart + len(lDates)])
+        lMatrix = fill_dense_matrix(np.zeros((len(lDates), len(lLevel0Uniq), len(iTargetCols))),
+                                    lDateCodes[lFirst:lLast] - lStart, lLeafCodes[lFirst:lLast],
+                                    lValues[lFirst:lLast])
+        yield create_full_df_from_dense_matrix(lDates, lLevel0Uniq, lMatrix, iHierarchy, iHierarchyOrder,
+                                               iTargetCols, iDateCol)
+
+
+def read_chunks(iPath, iChunkSize=100000, **kwargs):
+    """
+
+    :param iPath: path of a CSV file or of a Parquet file (.parquet, needs pyarrow)
+    :param iChunkSize: number of lines of each chunk (CSV only, Parquet files are read by row group)
+    :param kwargs: arguments of pd.read_csv
+    :return: generator of DFs
+    """
+    if iPath.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        lParquetFile = pq.ParquetFile(iPath)
+        for i in range(lParquetFile.num_row_groups):
+            yield lParquetFile.read_row_group(i).to_pandas()
     else:
-        lDateRange = pd.date_range(start=pd.to_datetime(iDateRange[0]), end=pd.to_datetime(iDateRange[1]), freq=iFreq)
+        for lChunk in pd.read_csv(iPath, chunksize=iChunkSize, **kwargs):
+            yield lChunk
 
-    lLevel0Uniq = iHierarchy.loc[:, lRevHierarchyOrder[0]].unique()
 
-    featuresDict = {iDateCol: lDateRange, lRevHierarchyOrder[0]: lLevel0Uniq}
+def create_level_df_dict_from_node_matrix(iDates, iNodeIndex, iMatrix, iTargetCols, iDateCol, iHierarchyOrder):
+    """
 
-    # Use tsUtils lib to create full dataset
-    oFullDf = cross_join_from_dict(featuresDict)
+    :param iDates: dates of iMatrix
+    :param iNodeIndex: node index of iMatrix rows
+    :param iMatrix: array (nodes x dates x iTargetCols), see create_node_date_matrix
+    :param iTargetCols: target cols
+    :param iDateCol: date column
+    :param iHierarchyOrder: hierarchy
+    :return: dict of df with 1 DF per level of the hierarchy (same as create_df_dict_for_each_level)
+    """
+    lRevHierarchyOrder = dict((v, k) for k, v in iHierarchyOrder.iteritems())
+    lNodeLevels = np.asarray(iNodeIndex.get_level_values(0))
+    lLabels = iNodeIndex.get_level_values(1)
+    oLevelDf = {}
+    for level in lRevHierarchyOrder.keys():
+        lRows = np.flatnonzero(lNodeLevels == level)
+        lLevelDf = pd.DataFrame({iDateCol: np.repeat(np.asarray(iDates), len(lRows))})
+        lLevelDf.loc[:, lRevHierarchyOrder[level]] = pd.Categorical.from_codes(np.tile(np.arange(len(lRows)),
+                                                                                       len(iDates)), lLabels[lRows])
+        lValues = np.asarray(iMatrix[lRows]).transpose(1, 0, 2).reshape(len(iDates) * len(lRows), -1)
+        for k, col in enumerate(iTargetCols):
+            lLevelDf.loc[:, col] = lValues[:, k]
+        oLevelDf[level] = lLevelDf
+    return oLevelDf
 
-    # Add info of destination for each transporteur
-    oFullDf = pd.merge(oFullDf, iHierarchy, on=lRevHierarchyOrder[0], how='left')
-    # Fill with data
-    oFullDf = pd.merge(oFullDf, iDf.groupby([iDateCol, lRevHierarchyOrder[0]], as_index=False)[iTargetCols].sum(),
-                       on=[iDateCol, lRevHierarchyOrder[0]], how='left').fillna(0)
 
-    return oFullDf
+def create_sliding_window_view(iArray, iWindow):
+    """
+
+    :param iArray: array (... x n)
+    :param iWindow: window size
+    :return: read-only view (... x n - iWindow + 1 x iWindow) of all windows of the last axis, no copy
+    """
+    lShape = iArray.shape[:-1] + (iArray.shape[-1] - iWindow + 1, iWindow)
+    lStrides = iArray.strides + (iArray.strides[-1],)
+    return np.lib.stride_tricks.as_strided(iArray, shape=lShape, strides=lStrides, writeable=False)
+
+
+def create_lag_features(iMatrix, iLags, iRollingWindows=None, iRollingFunctions=('mean',), iName=''):
+    """
+
+    Lags and rolling statistics of all series at once, read from a single sliding window view of the series
+    (the series are copied once with a NaN padding, never per lag)
+    :param iMatrix: array (nodes x dates) of series on a regular date grid, NaN where missing
+    :param iLags: list of lags (in number of dates, >= 1)
+    :param iRollingWindows: list of window sizes, rolling statistics are computed on lags 1 to window size
+    :param iRollingFunctions: rolling statistics ('mean', 'sum', 'min', 'max', 'std' with ddof=1 as pandas)
+    :param iName: prefix of feature names
+    :return: array (nodes x dates x features) of features (NaN where history is too short), feature names
+    """
+    lLags = list(iLags)
+    lRollingWindows = list(iRollingWindows) if iRollingWindows is not None else []
+    for lFunction in iRollingFunctions:
+        if lFunction not in ['mean', 'sum', 'min', 'max', 'std']:
+            raise ValueError('Unknown rolling function : ' + str(lFunction))
+    if len(lLags + lRollingWindows) == 0 or min(lLags + lRollingWindows) < 1:
+        raise ValueError('Lags and rolling windows must be >= 1')
+
+    lNbNodes, lNbDates = iMatrix.shape
+    lDepth = max(lLags + lRollingWindows)
+    lPadded = np.full((lNbNodes, lNbDates + lDepth), np.nan)
+    lPadded[:, lDepth:] = iMatrix
+    # Window of date t holds dates t - lDepth to t - 1 : lag k is at position lDepth - k
+    lWindows = create_sliding_window_view(lPadded, lDepth)[:, :lNbDates]
+
+    oNames = [iName + '_lag' + str(lag) for lag in lLags]
+    oNames += [iName + '_rolling_' + lFunction + str(lWindow) for lWindow in lRollingWindows
+               for lFunction in iRollingFunctions]
+    oFeatures = np.empty((lNbNodes, lNbDates, len(oNames)))
+    oFeatures[:, :, :len(lLags)] = lWindows[:, :, [lDepth - lag for lag in lLags]]
+    k = len(lLags)
+    for lWindow in lRollingWindows:
+        for lFunction in iRollingFunctions:
+            lWindowValues = lWindows[:, :, lDepth - lWindow:]
+            if lFunction == 'std':
+                # Sample standard deviation, as pandas rolling std
+                oFeatures[:, :, k] = np.std(lWindowValues, axis=2, ddof=1)
+            else:
+                oFeatures[:, :, k] = getattr(np, lFunction)(lWindowValues, axis=2)
+            k += 1
+
+    return oFeatures, oNames
+
+
+def add_lag_features(iLevelDf, iDateCol, iLevelCol, iTargetCol, iLags, iRollingWindows=None,
+                     iRollingFunctions=('mean',), iFreq='D', iDropNa=True):
+    """
+
+    Adds lags and rolling statistics of iTargetCol (at the same node, iFreq dates before) to a level DF
+    :param iLevelDf: DF of a level (see create_df_dict_for_each_level)
+    :param iDateCol: date column
+    :param iLevelCol: level column
+    :param iTargetCol: target column
+    :param iLags: list of lags (in number of iFreq periods)
+    :param iRollingWindows: list of window sizes of rolling statistics
+    :param iRollingFunctions: rolling statistics ('mean', 'sum', 'min', 'max', 'std')
+    :param iFreq: frequency of dates
+    :param iDropNa: if True, drops rows with a missing feature
+    :return: DF with features columns iTargetCol + '_lag' + str(lag) and iTargetCol + '_rolling_' + function + window
+    """
+    lDates = pd.date_range(iLevelDf.loc[:, iDateCol].min(), iLevelDf.loc[:, iDateCol].max(), freq=iFreq)
+    lDateCodes = lDates.get_indexer(iLevelDf.loc[:, iDateCol])
+    if (lDateCodes < 0).any():
+        raise ValueError('Dates of ' + str(iDateCol) + ' are not on a ' + str(iFreq) + ' grid')
+    lNodeCodes, lNodes = pd.factorize(iLevelDf.loc[:, iLevelCol])
+
+    lMatrix = np.full((len(lNodes), len(lDates)), np.nan)
+    lMatrix[lNodeCodes, lDateCodes] = iLevelDf.loc[:, iTargetCol].values
+    lFeatures, lNames = create_lag_features(lMatrix, iLags, iRollingWindows, iRollingFunctions, iTargetCol)
+
+    oDf = iLevelDf.copy()
+    lValues = lFeatures[lNodeCodes, lDateCodes]
+    for k, name in enumerate(lNames):
+        oDf.loc[:, name] = lValues[:, k]
+    if iDropNa:
+        oDf = oDf.dropna(subset=lNames)
+    return oDf
+
+
+def create_cache_key(iSourcePath, iHierarchyOrder, iTargetCols, iDateCol, iFreq, iHierarchyDf=None, iVersion=None):
+    """
+
+    :param iSourcePath: path of source data file
+    :param iHierarchyOrder: hierarchy order
+    :param iTargetCols: target cols
+    :param iDateCol: date column
+    :param iFreq: frequency of dates
+    :param iHierarchyDf: hierarchy DF whose content (node -> parent assignments, whatever its row order) is part of
+    the key (None if it only depends on the source file)
+    :param iVersion: caller-supplied version token of the loading code, part of the key
+    :return: sha1 of source file content, of the hierarchy definition and content, and of the version token
+    """
+    lHash = hashlib.sha1()
+    with open(iSourcePath, 'rb') as lFile:
+        for lBlock in iter(lambda: lFile.read(1 << 20), b''):
+            lHash.update(lBlock)
+    lHash.update(repr((sorted(iHierarchyOrder.items()), list(iTargetCols), iDateCol, iFreq, iVersion)).encode('utf-8'))
+    if iHierarchyDf is not None:
+        lHierarchyDf = iHierarchyDf.loc[:, sorted(iHierarchyOrder.keys())].astype(str)
+        lHash.update(repr(list(lHierarchyDf.columns)).encode('utf-8'))
+        lHash.update(np.sort(pd.util.hash_pandas_object(lHierarchyDf, index=False).values))
+    return lHash.hexdigest()
+
+
+def load_level_cache(iCacheDir, iSourcePath, iLoadFunction, iHierarchyOrder, iTargetCols, iDateCol, iFreq,
+                     iHierarchyDf=None, iVersion=None):
+    """
+
+    Cache of prepared datasets in iCacheDir/<key> (see create_cache_key) : arrays are stored as .npy files and are
+    memory mapped when cache is warm, so source file is not parsed again
+    :param iCacheDir: cache directory
+    :param iSourcePath: path of source data file
+    :param iLoadFunction: function(iSourcePath) returning (DF of data, hierarchy DF), only called on cold start
+    :param iHierarchyOrder: hierarchy order
+    :param iTargetCols: target cols
+    :param iDateCol: date column
+    :param iFreq: frequency of dates
+    :param iHierarchyDf: hierarchy DF when it is not only read from the source file (e.g. parents assigned in code) :
+    its content is part of the cache key and it is used instead of the hierarchy returned by iLoadFunction
+    :param iVersion: caller-supplied version token of iLoadFunction (change it when the loading code changes)
+    :return: dict with 'hierarchy' (DF), 'dates', 'level0' (level 0 nodes), 'leaf_matrix' (dates x level 0 nodes x
+    iTargetCols), 'node_index', 'node_matrix' (nodes x dates x iTargetCols)
+    """
+    lCachePath = os.path.join(iCacheDir, create_cache_key(iSourcePath, iHierarchyOrder, iTargetCols, iDateCol, iFreq,
+                                                          iHierarchyDf, iVersion))
+
+    if not os.path.isdir(lCachePath):
+        lDf, lHierarchy = iLoadFunction(iSourcePath)
+        if iHierarchyDf is not None:
+            lHierarchy = iHierarchyDf
+        lDates, lLevel0Uniq, lLeafMatrix = create_dense_leaf_matrix(lDf, lHierarchy, iHierarchyOrder, iTargetCols,
+                                                                    iDateCol, iFreq)
+        lHandler = cHierarchyHandler(lHierarchy, iHierarchyOrder)
+        lSummingMatrix, lNodeIndex = lHandler.create_sparse_summing_matrix()
+        # Leaf matrix columns in the order of summing matrix columns
+        lLeafMatrix = lLeafMatrix[:, lLevel0Uniq.get_indexer(lNodeIndex.get_level_values(1)[:lSummingMatrix.shape[1]])]
+        lNodeMatrix = lSummingMatrix.dot(lLeafMatrix.transpose(1, 0, 2).reshape(lSummingMatrix.shape[1], -1))
+
+        # Written in a temporary directory first : an interrupted run never leaves a partial cache
+        lTmpPath = lCachePath + '.tmp' + str(os.getpid())
+        os.makedirs(lTmpPath)
+        lHierarchy.to_pickle(os.path.join(lTmpPath, 'hierarchy.pkl'))
+        np.save(os.path.join(lTmpPath, 'dates.npy'), np.asarray(lDates))
+        np.save(os.path.join(lTmpPath, 'leaf_matrix.npy'), lLeafMatrix)
+        np.save(os.path.join(lTmpPath, 'node_levels.npy'), np.asarray(lNodeIndex.get_level_values(0)))
+        np.save(os.path.join(lTmpPath, 'node_labels.npy'), np.asarray(lNodeIndex.get_level_values(1), dtype=object))
+        np.save(os.path.join(lTmpPath, 'node_matrix.npy'),
+                lNodeMatrix.reshape(len(lNodeIndex), len(lDates), len(iTargetCols)))
+        try:
+            os.rename(lTmpPath, lCachePath)
+        except OSError:
+            # Written meanwhile by another process
+            shutil.rmtree(lTmpPath)
+
+    lNodeLabels = np.load(os.path.join(lCachePath, 'node_labels.npy'), allow_pickle=True)
+    lNodeIndex = pd.MultiIndex.from_arrays([np.load(os.path.join(lCachePath, 'node_levels.npy')), lNodeLabels],
+                                           names=['Level', 'Node'])
+    lLeafMatrix = np.load(os.path.join(lCachePath, 'leaf_matrix.npy'), mmap_mode='r')
+    return {'hierarchy': pd.read_pickle(os.path.join(lCachePath, 'hierarchy.pkl')),
+            'dates': pd.DatetimeIndex(np.load(os.path.join(lCachePath, 'dates.npy'))),
+            'level0': pd.Index(lNodeLabels[:lLeafMatrix.shape[1]]),
+            'leaf_matrix': lLeafMatrix,
+            'node_index': lNodeIndex,
+            'node_matrix': np.load(os.path.join(lCachePath, 'node_matrix.npy'), mmap_mode='r')}
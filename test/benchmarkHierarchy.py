@@ -0,0 +1,124 @@
+# Benchmark of hierarchy building, data preparation and reconciliation methods on synthetic hierarchies
+# Run from this directory with hts in the python path, e.g. :
+# PYTHONPATH=../hts python benchmarkHierarchy.py --leaves 1000 10000 100000 --output benchmark.jsonl
+# Each line of the output file is a JSON record (size, stage, seconds, peak memory) to track regressions
+
+import argparse
+import gc
+import json
+import platform
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 : peak memory is sampled from the resident size of the process
+    tracemalloc = None
+
+import hierarchyHandler as hh
+import htsMethods as htsm
+from htsProfiler import cResidentSizeSampler
+import htsSynthetic as htss
+import tsUtils as tsu
+
+
+def measure(iFunction, *args, **kwargs):
+    """
+
+    :return: result of iFunction, wall time in seconds, peak memory allocated during the call in MB
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    else:
+        lSampler = cResidentSizeSampler()
+        lSampler.start()
+    lStart = time.time()
+    oResult = iFunction(*args, **kwargs)
+    lSeconds = time.time() - lStart
+    if tracemalloc is not None:
+        lPeak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        lPeak = lSampler.stop()
+    return oResult, lSeconds, lPeak / 1024. ** 2 if lPeak is not None else None
+
+
+def run_size(iNbLeaves, iArgs, iOutput):
+    """
+
+    Runs all stages for a hierarchy of iNbLeaves base nodes and writes 1 record per stage
+    """
+    lHierarchy, lHierarchyOrder = htss.create_synthetic_hierarchy(iNbLeaves, iArgs.fan_out, iArgs.depth)
+    lHistory = htss.create_synthetic_series(lHierarchy, lHierarchyOrder, iArgs.dates, iMissingRate=0.1)
+    lRecord = {'leaves': iNbLeaves, 'fan_out': iArgs.fan_out, 'depth': iArgs.depth, 'dates': iArgs.dates,
+               'python': platform.python_version(),
+               'memory_metric': 'tracemalloc' if tracemalloc is not None else 'rss_increase'}
+
+    def run_stage(iStage, iFunction, *args, **kwargs):
+        oResult, lSeconds, lPeak = measure(iFunction, *args, **kwargs)
+        lStageRecord = dict(lRecord, stage=iStage, seconds=round(lSeconds, 6),
+                            peak_mb=round(lPeak, 3) if lPeak is not None else None)
+        iOutput.write(json.dumps(lStageRecord, sort_keys=True) + '\n')
+        iOutput.flush()
+        print('%8d leaves  %-45s %10.3f s %10.1f MB' % (iNbLeaves, iStage, lSeconds, lPeak or 0.))
+        return oResult
+
+    # Hierarchy
+    run_stage('create_structure',
+              lambda: hh.cHierarchyHandler(lHierarchy, lHierarchyOrder).create_structure())
+    lSummingMatrix, lNodeIndex = run_stage(
+        'create_sparse_summing_matrix',
+        lambda: hh.cHierarchyHandler(lHierarchy, lHierarchyOrder).create_sparse_summing_matrix())
+    lRecord['nodes'] = len(lNodeIndex)
+    if len(lNodeIndex) * iNbLeaves * 8 <= iArgs.max_dense_mb * 1024 ** 2:
+        run_stage('create_summing_matrix',
+                  lambda: hh.cHierarchyHandler(lHierarchy, lHierarchyOrder).create_summing_matrix())
+
+    # Data preparation
+    lFullDf = run_stage('create_full_df_with_hierarchy', tsu.create_full_df_with_hierarchy, lHistory, lHierarchy,
+                        lHierarchyOrder, ['Value'], 'Date', 'D')
+    lLevelDfs = run_stage('create_df_dict_for_each_level', tsu.create_df_dict_for_each_level, lFullDf, 'Date',
+                          ['Value'], lHierarchyOrder, iFromLevelBelow=True)
+    run_stage('create_node_date_matrix', tsu.create_node_date_matrix, lHistory, 'Date', ['Value'], lHierarchyOrder,
+              lSummingMatrix, lNodeIndex)
+    del lFullDf
+
+    # Reconciliation
+    lForecastDfs = htss.create_synthetic_forecasts(lLevelDfs)
+    lOptim = run_stage('cHtsOptimizer', htsm.cHtsOptimizer, lForecastDfs, iInitialForecastCol='Forecast',
+                       iDateCol='Date', iHierarchyDf=lHierarchy, iHierarchyOrder=lHierarchyOrder)
+    p1, p2 = run_stage('computeTopDownHistoricalProportions', lOptim.computeTopDownHistoricalProportions,
+                       lForecastDfs, iTsCol='Value')
+    run_stage('computeTopDownForecasts', lOptim.computeTopDownForecasts, p1, 'TD')
+    run_stage('computeTopDownForecastProportions', lOptim.computeTopDownForecastProportions)
+    run_stage('computeBottomUpForecasts', lOptim.computeBottomUpForecasts)
+    run_stage('computeMiddleOutForecasts', lOptim.computeMiddleOutForecasts, p2, 1)
+    run_stage('computeOptimalCombination', lOptim.computeOptimalCombination)
+    if len(lNodeIndex) ** 2 * 8 <= iArgs.max_dense_mb * 1024 ** 2:
+        run_stage('computeOptimalCombination_dense', lOptim.computeOptimalCombination, iSolver='dense')
+    lResiduals = lOptim.create_forecast_matrix('Forecast') - lOptim.create_forecast_matrix('Value')
+    for lWeighting in ['wls_struct', 'wls_var', 'mint_shrink']:
+        run_stage('computeWeightedOptimalCombination_' + lWeighting, lOptim.computeWeightedOptimalCombination,
+                  lWeighting, lResiduals)
+
+
+def main():
+    lParser = argparse.ArgumentParser(description='Benchmark of hts on synthetic hierarchies')
+    lParser.add_argument('--leaves', type=int, nargs='+', default=[1000, 10000, 100000],
+                         help='numbers of base nodes')
+    lParser.add_argument('--fan-out', type=int, default=10, help='number of children of each node')
+    lParser.add_argument('--depth', type=int, default=4, help='number of levels (including total)')
+    lParser.add_argument('--dates', type=int, default=28, help='number of dates')
+    lParser.add_argument('--max-dense-mb', type=float, default=500.,
+                         help='dense paths (summing matrix, dense OC) are skipped above this size')
+    lParser.add_argument('--output', default='benchmark.jsonl', help='JSON lines output file')
+    lArgs = lParser.parse_args()
+
+    with open(lArgs.output, 'a') as lOutput:
+        for lNbLeaves in lArgs.leaves:
+            run_size(lNbLeaves, lArgs, lOutput)
+
+
+if __name__ == '__main__':
+    main()
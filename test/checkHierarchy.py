@@ -0,0 +1,129 @@
+# Checks of hierarchy validation and of the coherence of reconciled forecasts on grouped hierarchies
+# Run from this directory with hts in the python path, e.g. :
+# PYTHONPATH=../hts python checkHierarchy.py
+# Each check prints its max absolute difference and fails with an AssertionError above its tolerance
+
+import numpy as np
+import pandas as pd
+
+import hierarchyHandler as hh
+import htsMethods as htsm
+import tsUtils as tsu
+from checkSolvers import check
+
+
+def check_value_error(iName, iFunction):
+    """
+
+    Asserts that iFunction raises a ValueError
+    """
+    try:
+        iFunction()
+    except ValueError as e:
+        print('%-50s %10s' % (iName, 'ok'))
+        return str(e)
+    raise AssertionError(iName + ' : no ValueError')
+
+
+def create_level_dfs(iHandler, iLeaves, iNbDates, iSeed=0):
+    """
+
+    :return: dict of DFs (1 per level) of random values ('Value') and noisy forecasts ('Forecast') of iLeaves
+    """
+    lRandom = np.random.RandomState(iSeed)
+    lDates = pd.date_range('2016-01-01', periods=iNbDates)
+    lFullDf = pd.concat([iLeaves.assign(Date=lDate) for lDate in lDates], ignore_index=True)
+    lFullDf.loc[:, 'Value'] = lRandom.gamma(2., 5., lFullDf.shape[0])
+    if iHandler.mAxesOrders is not None:
+        lFullDf = iHandler.add_grouping_columns(lFullDf)
+    oLevelDfs = tsu.create_df_dict_for_each_level(lFullDf, 'Date', ['Value'], iHandler.mHierarchyOrder)
+    for lLevelDf in oLevelDfs.values():
+        lLevelDf.loc[:, 'Forecast'] = lLevelDf.loc[:, 'Value'] * (1. + 0.2 * lRandom.standard_normal(
+            lLevelDf.shape[0]))
+    return oLevelDfs
+
+
+def check_coherence(iName, iOptim, iForecasts):
+    """
+
+    Asserts S.base == all levels for an array (nodes x dates) of reconciled forecasts
+    """
+    S = iOptim.mSummingMatrix
+    check(iName, S.dot(iForecasts[:S.shape[1]]), iForecasts)
+
+
+def check_grouped_hierarchy():
+    """
+
+    Two axes (Sku -> Cat, Store -> Region) : all levels are coherent after BU, TD, TDFP, MO and OC
+    """
+    lLeaves = pd.DataFrame([('S' + str(s), 'C' + str(s % 3), 'T' + str(t), 'R' + str(t % 2))
+                            for s in range(6) for t in range(4)], columns=['Sku', 'Cat', 'Store', 'Region'])
+    lAxes = [{'Sku': 0, 'Cat': 1}, {'Store': 0, 'Region': 1}]
+    lLevelDfs = create_level_dfs(hh.cHierarchyHandler(lLeaves, lAxes), lLeaves, 10)
+    lOptim = htsm.cHtsOptimizer(lLevelDfs, iInitialForecastCol='Forecast', iDateCol='Date', iHierarchyDf=lLeaves,
+                                iHierarchyOrder=lAxes)
+    lForecasts = lOptim.create_forecast_matrix()
+    lProp1, lProp2 = lOptim.computeTopDownHistoricalProportions(lLevelDfs, iTsCol='Value')
+
+    check_coherence('grouped BU coherent', lOptim, lOptim.reconcile_forecast_matrix(lForecasts, 'BU'))
+    check_coherence('grouped TD (p1) coherent', lOptim, lOptim.reconcile_forecast_matrix(lForecasts, 'TD', lProp1))
+    check_coherence('grouped TD (p2) coherent', lOptim, lOptim.reconcile_forecast_matrix(lForecasts, 'TD', lProp2))
+    check_coherence('grouped TDFP coherent', lOptim, lOptim.reconcile_forecast_matrix(lForecasts, 'TDFP'))
+    check_coherence('grouped OC coherent', lOptim, lOptim.reconcile_forecast_matrix(lForecasts, 'OC'))
+    lStructure = lOptim.get_compact_structure()
+    for lMidLevel in lOptim.get_allocation_levels(max(lStructure.mLevels)):
+        check_coherence('grouped MO (mid level ' + str(lMidLevel) + ') coherent', lOptim,
+                        lOptim.reconcile_forecast_matrix(lForecasts, 'MO', lProp2, lMidLevel))
+    # Mid levels off the path of parent levels of the base level can not be allocated down to it
+    lOffPath = sorted(set(lStructure.mLevels) - set(lOptim.get_allocation_levels(max(lStructure.mLevels))) -
+                      set([max(lStructure.mLevels)]))
+    check_value_error('grouped MO off the path of parent levels',
+                      lambda: lOptim.reconcile_forecast_matrix(lForecasts, 'MO', lProp2, lOffPath[0]))
+
+    # A child with 2 parents in an axis
+    lBadLeaves = lLeaves.copy()
+    lBadLeaves.loc[0, 'Cat'] = 'C9'
+    check_value_error('grouped child with 2 parents in an axis',
+                      lambda: hh.cHierarchyHandler(lBadLeaves, lAxes).get_compact_structure())
+
+
+def check_reused_labels():
+    """
+
+    Labels used at several levels (Store A, B, C -> Region A, A, C -> All 'A') are different nodes : proportions
+    of each (parent, child) link are kept apart and TD allocates the base forecast of the top level
+    """
+    lLeaves = pd.DataFrame({'Store': ['A', 'B', 'C'], 'Region': ['A', 'A', 'C'], 'All': 'A'})
+    lHierarchyOrder = {'Store': 0, 'Region': 1, 'All': 2}
+    lLevelDfs = create_level_dfs(hh.cHierarchyHandler(lLeaves, lHierarchyOrder), lLeaves, 10, iSeed=1)
+    lOptim = htsm.cHtsOptimizer(lLevelDfs, iInitialForecastCol='Forecast', iDateCol='Date', iHierarchyDf=lLeaves,
+                                iHierarchyOrder=lHierarchyOrder)
+    lProp1, lProp2 = lOptim.computeTopDownHistoricalProportions(lLevelDfs, iTsCol='Value')
+
+    # Explicit average of historical proportions Store A / Region A
+    lStores = lLevelDfs[0].set_index(['Date', 'Store']).loc[:, 'Value']
+    lRegions = lLevelDfs[1].set_index(['Date', 'Region']).loc[:, 'Value']
+    lExpected = np.mean([lStores[(lDate, 'A')] / lRegions[(lDate, 'A')] for lDate in lOptim.mDates])
+    check('reused labels : proportion of Store A in Region A', lProp1[(1, 'A')][(0, 'A')], lExpected, 1e-12)
+
+    lForecasts = lOptim.create_forecast_matrix()
+    lTopDown = lOptim.reconcile_forecast_matrix(lForecasts, 'TD', lProp1)
+    check_coherence('reused labels : TD coherent', lOptim, lTopDown)
+    lTop = lOptim.mLevelSlices[2]
+    check('reused labels : TD keeps the top forecast', lTopDown[lTop], lForecasts[lTop])
+
+    # Proportions keyed by labels only are ambiguous here
+    lLabelProp = dict((lParent[1], dict((lChild[1], p) for lChild, p in lChildren.items()))
+                      for lParent, lChildren in lProp1.items())
+    check_value_error('reused labels : proportions keyed by labels',
+                      lambda: lOptim.reconcile_forecast_matrix(lForecasts, 'TD', lLabelProp))
+
+
+def main():
+    check_grouped_hierarchy()
+    check_reused_labels()
+
+
+if __name__ == '__main__':
+    main()
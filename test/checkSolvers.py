@@ -0,0 +1,105 @@
+# Checks of reconciliation solvers against explicit dense formulas on a small synthetic hierarchy
+# Run from this directory with hts in the python path, e.g. :
+# PYTHONPATH=../hts python checkSolvers.py
+# Each check prints its max absolute difference and fails with an AssertionError above its tolerance
+
+import numpy as np
+
+import htsMethods as htsm
+from htsSolvers import create_shrinkage_covariance
+import htsSynthetic as htss
+import tsUtils as tsu
+
+
+def check(iName, iValue, iExpected, iTolerance=1e-8):
+    """
+
+    Prints the max absolute difference between iValue and iExpected and asserts it is below iTolerance
+    """
+    lDiff = np.abs(np.asarray(iValue) - np.asarray(iExpected)).max()
+    print('%-50s %10.3g' % (iName, lDiff))
+    assert lDiff <= iTolerance, iName + ' : max difference ' + str(lDiff) + ' above ' + str(iTolerance)
+
+
+def create_gls_reconciliation(iSummingMatrix, iCovariance, iForecasts):
+    """
+
+    :return: explicit GLS reconciliation S.inv(S'.inv(W).S).S'.inv(W).y (dense)
+    """
+    S = iSummingMatrix.toarray()
+    lStWInv = np.linalg.solve(iCovariance, S).T
+    return S.dot(np.linalg.solve(lStWInv.dot(S), lStWInv.dot(iForecasts)))
+
+
+def create_shrinkage_lambda(iResiduals):
+    """
+
+    :return: explicit Schafer and Strimmer shrinkage intensity, on nodes pairs (nodes x nodes x dates products)
+    """
+    lNbDates = iResiduals.shape[1]
+    lVariances = (iResiduals ** 2).mean(axis=1)
+    lXs = iResiduals[lVariances > 0] / np.sqrt(lVariances[lVariances > 0])[:, np.newaxis]
+    lProducts = lXs[:, np.newaxis, :] * lXs[np.newaxis, :, :]
+    lCorrelations = lProducts.mean(axis=2)
+    lVarCorrelations = ((lProducts - lCorrelations[:, :, np.newaxis]) ** 2).sum(axis=2) / (lNbDates * (lNbDates - 1))
+    lOffDiagonal = ~np.eye(lXs.shape[0], dtype=bool)
+    return max(min(lVarCorrelations[lOffDiagonal].sum() / (lCorrelations[lOffDiagonal] ** 2).sum(), 1.), 0.)
+
+
+def main():
+    lHierarchy, lHierarchyOrder = htss.create_synthetic_hierarchy(60, 4, 4)
+    lHistory = htss.create_synthetic_series(lHierarchy, lHierarchyOrder, 40, iMissingRate=0.1)
+    lFullDf = tsu.create_full_df_with_hierarchy(lHistory, lHierarchy, lHierarchyOrder, ['Value'], 'Date', 'D')
+    lLevelDfs = htss.create_synthetic_forecasts(
+        tsu.create_df_dict_for_each_level(lFullDf, 'Date', ['Value'], lHierarchyOrder, iFromLevelBelow=True))
+    lOptim = htsm.cHtsOptimizer(lLevelDfs, iInitialForecastCol='Forecast', iDateCol='Date', iHierarchyDf=lHierarchy,
+                                iHierarchyOrder=lHierarchyOrder)
+    S = lOptim.mSummingMatrix
+    lForecasts = lOptim.create_forecast_matrix()
+    lResiduals = lForecasts - lOptim.create_forecast_matrix('Value')
+
+    # OLS : sparse (Woodbury) and dense solvers against the explicit formula
+    lExpected = create_gls_reconciliation(S, np.identity(S.shape[0]), lForecasts)
+    check('OLS sparse vs explicit', lOptim.reconcile_forecast_matrix(lForecasts, 'OC'), lExpected)
+    check('OLS dense vs explicit', lOptim.reconcile_forecast_matrix(lForecasts, 'OC', iSolver='dense'), lExpected)
+
+    # WLS and MinT shrink : sparse and dense weighted solvers against the explicit GLS formula
+    lVariances = (lResiduals ** 2).mean(axis=1)
+    lLambda = create_shrinkage_lambda(lResiduals)
+    lCovariances = {'wls_struct': np.diag(np.asarray(S.sum(axis=1)).ravel()),
+                    'wls_var': np.diag(lVariances),
+                    'mint_shrink': lLambda * np.diag(lVariances) +
+                    (1. - lLambda) * lResiduals.dot(lResiduals.T) / lResiduals.shape[1]}
+    for lWeighting in ['wls_struct', 'wls_var', 'mint_shrink']:
+        lExpected = create_gls_reconciliation(S, lCovariances[lWeighting], lForecasts)
+        for lSolver in ['sparse', 'dense']:
+            lWeightedSolver = lOptim.get_weighted_solver(lWeighting, lResiduals, lSolver)
+            check(lWeighting + ' ' + lSolver + ' vs explicit GLS', lWeightedSolver.reconcile(lForecasts), lExpected)
+
+    # Shrinkage intensity, also with a node of zero residuals (left out of correlations)
+    check('shrinkage lambda vs explicit', create_shrinkage_covariance(lResiduals)[2], lLambda, 1e-12)
+    lZeroResiduals = lResiduals.copy()
+    lZeroResiduals[-1] = 0.
+    check('shrinkage lambda with zero residuals vs explicit', create_shrinkage_covariance(lZeroResiduals)[2],
+          create_shrinkage_lambda(lZeroResiduals), 1e-12)
+    check('shrinkage lambda with zero residuals vs other nodes', create_shrinkage_covariance(lZeroResiduals)[2],
+          create_shrinkage_covariance(lResiduals[:-1])[2], 1e-12)
+
+    # Incremental mode : each date reconciled alone vs all dates at once
+    lProp = lOptim.computeTopDownHistoricalProportions(lLevelDfs, iTsCol='Value')[0]
+    lWeightedSolver = lOptim.get_weighted_solver('mint_shrink', lResiduals)
+    for lName, lMethod, lSolver in [('BU', 'BU', 'sparse'), ('TD', 'TD', 'sparse'), ('MO', 'MO', 'sparse'),
+                                    ('OLS', 'OC', 'sparse'), ('mint_shrink', 'OC', lWeightedSolver)]:
+        lExpected = lOptim.reconcile_forecast_matrix(lForecasts, lMethod, lProp, 1, lSolver)
+        for lDate in lOptim.mDates:
+            lDayDfs = dict((level, lLevelDf.loc[lLevelDf.loc[:, 'Date'] == lDate, :])
+                           for level, lLevelDf in lLevelDfs.items())
+            lDayForecasts = lOptim.create_forecast_matrix(
+                'Forecast_INC', lOptim.computeIncrementalForecasts(lDayDfs, lMethod, 'INC', lProp, 1, lSolver))
+            lDayDiff = np.abs(lDayForecasts[:, 0] - lExpected[:, lOptim.mDates.get_loc(lDate)]).max()
+            assert lDayDiff <= 1e-8, lName + ' incremental on ' + str(lDate) + ' : max difference ' + str(lDayDiff)
+        print('%-50s %10s' % (lName + ' incremental day by day vs all dates', 'ok'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
+from functools import partial
+
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 
+import htsForecaster as htsf
 import htsMethods as htsm
 import tsUtils as tsu
 
@@ -29,48 +32,27 @@ fullDf = tsu.create_full_df_with_hierarchy(data_log, hierarchy, hierarchyOrder,
                                            iFromDateCol=True)
 
 # BUILD DATASETS FOR EACH LEVELS
-level_dfs = tsu.create_df_dict_for_each_level(fullDf, 'DateDay', ['NbColis'], hierarchyOrder)
+level_dfs = tsu.create_df_dict_for_each_level(fullDf, 'DateDay', ['NbColis'], hierarchyOrder, iFromLevelBelow=True)
 
 # Featurize data for each level
-featured_level_dfs = level_dfs.copy()
+# Add lagged features with data from Day-1, Day-2, .., Day-4
+featured_level_dfs = {}
 for level in revHierarchyOrder.keys():
-    for i in range(1, 5):
-        # Add lagged features with data from Day-1, Day-2, .., Day-4
-        featured_level_dfs[level] = pd.merge(featured_level_dfs[level], level_dfs[level].set_index('DateDay')
-                                             .groupby(revHierarchyOrder[level])[['NbColis']]
-                                             .tshift(i, 'D')
-                                             .rename(columns={'NbColis': 'NbColis_lag' + str(i)})
-                                             .reset_index(), on=['DateDay', revHierarchyOrder[level]], how='left') \
-            .dropna()
+    featured_level_dfs[level] = tsu.add_lag_features(level_dfs[level], 'DateDay', revHierarchyOrder[level], 'NbColis',
+                                                     range(1, 5))
 
 # Split date for training and testing sets
 date_threshold = pd.to_datetime('2016-06-30')
-# Create models for each levels
-rf = RandomForestRegressor(n_jobs=-1, random_state=123)
-results_level_dfs = {}
-
+# Create models for each node of each level (fitted in parallel)
+level_trs = {}
+level_tss = {}
 for level in revHierarchyOrder.keys():
-    results_current_lvl = []
-
-    # For each level
-    current_level_tr, current_level_ts = tsu.split_tr_test(featured_level_dfs[level], 'DateDay', date_threshold)
-    current_level_tr = current_level_tr.groupby(revHierarchyOrder[level])
-    current_level_ts = current_level_ts.groupby(revHierarchyOrder[level])
-
-    # For each value in current level
-    for name, group in current_level_tr:
-        current_tr_df = current_level_tr.get_group(name)
-        current_ts_df = current_level_ts.get_group(name).copy()
-        # Fit !
-        rf.fit(current_tr_df.loc[:, ['NbColis_lag' + str(i) for i in range(1, 5)]].values,
-               current_tr_df.loc[:, 'NbColis'].values)
-        current_ts_df.loc[:, 'Forecast'] = rf.predict(
-            current_ts_df.loc[:, ['NbColis_lag' + str(i) for i in range(1, 5)]].values)
-
-        results_current_lvl.append(
-            current_ts_df.loc[:, ['DateDay', revHierarchyOrder[level], 'NbColis', 'Forecast']])
-
-    results_level_dfs[level] = pd.concat(results_current_lvl)
+    level_trs[level], level_tss[level] = tsu.split_tr_test(featured_level_dfs[level], 'DateDay', date_threshold)
+# Prediction of each tree of the forests are kept as sample paths (Forecast_s0, ..., Forecast_s9)
+forecaster = htsf.cHtsForecaster(partial(RandomForestRegressor, n_estimators=10, n_jobs=1, random_state=123),
+                                 ['NbColis_lag' + str(i) for i in range(1, 5)], 'NbColis', 'DateDay', hierarchyOrder,
+                                 iSampleFunction=htsf.predict_estimators, iNbSamples=10)
+results_level_dfs = forecaster.computeBaseForecasts(level_trs, level_tss)
 
 ##################################################################################################################
 # USE OF HTS HERE
@@ -85,6 +67,8 @@ hts_optim = htsm.cHtsOptimizer(results_level_dfs, iInitialForecastCol='Forecast'
 p1, p2 = hts_optim.computeTopDownHistoricalProportions(results_level_dfs, iTsCol='NbColis')
 td_res_p1 = hts_optim.computeTopDownForecasts(p1, '_TD_p1')
 td_res_p2 = hts_optim.computeTopDownForecasts(p2, '_TD_p2')
+# Or with proportions of the forecasts themselves
+td_res_fp = hts_optim.computeTopDownForecastProportions(iPrefix='TD_fp')
 
 # BOTTOM - UP APPROACH
 bu_res = hts_optim.computeBottomUpForecasts()
@@ -95,6 +79,10 @@ mo_res_p2 = hts_optim.computeMiddleOutForecasts(p2, iMidLevel=1, iPrefix='MO_p2'
 
 # OPTIMAL APPROACH WITH PSEUDO INVERSE OF SUMMING MATRIX
 oc_res = hts_optim.computeOptimalCombination(iPrefix='OC')
+
+# COHERENT PREDICTION INTERVALS : QUANTILES OF RECONCILED SAMPLE PATHS
+oc_quantiles = hts_optim.computeReconciledQuantiles(['Forecast_s' + str(i) for i in range(10)], [0.1, 0.5, 0.9],
+                                                    iMethod='OC', iPrefix='OC')
 ##################################################################################################################
 # END
 ##################################################################################################################